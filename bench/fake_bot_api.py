@@ -0,0 +1,132 @@
+# bench/fake_bot_api.py
+# -*- coding: utf-8 -*-
+"""سرور جعلی Bot API برای بنچمارک: پاسخ‌های حداقلی، تأخیر قابل تنظیم و تزریق 429.
+
+اجرای مستقل:
+    python bench/fake_bot_api.py --port 8081 --latency-ms 40 --jitter-ms 20 --p429 0.01
+سپس در ربات: BOT_API_BASE_URL=http://127.0.0.1:8081/bot
+"""
+import time
+import json
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "BenchBot", "username": "bench_bot"}
+
+
+def _chat(chat_id: int) -> dict:
+    if chat_id < 0:
+        return {"id": chat_id, "type": "supergroup", "title": f"گروه {chat_id}"}
+    return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+
+
+def _chat_id(params: dict) -> int:
+    raw = params.get("chat_id", 0)
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        return -1  # @channel
+
+
+class FakeBotApi:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, p429: float = 0.0, retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.calls: dict = {}
+        self.throttled: dict = {}
+        self._message_id = 1000
+
+    def _next_message(self, params: dict) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": _chat(_chat_id(params)),
+            "from": BOT_USER,
+            "text": params.get("text") or "",
+        }
+
+    def result_for(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "forwardMessage", "copyMessage"):
+            return self._next_message(params)
+        if method == "getChat":
+            return _chat(_chat_id(params))
+        if method == "getChatMember":
+            return {"status": "member", "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "u"}}
+        if method == "getChatMemberCount":
+            return 42
+        if method == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": 777, "is_bot": False, "first_name": "owner"}}]
+        if method == "getUpdates":
+            return []
+        # deleteMessage, answerCallbackQuery, answerInlineQuery, edit*, setWebhook, ...
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = {}
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                params = await request.json()
+            else:
+                for k, v in (await request.post()).items():
+                    try:
+                        params[k] = json.loads(v) if isinstance(v, str) else v
+                    except ValueError:
+                        params[k] = v
+        if method == "getUpdates":
+            # بنچمارک آپدیت‌ها را مستقیم تزریق می‌کند؛ long polling فقط منتظر می‌ماند
+            await asyncio.sleep(min(float(params.get("timeout") or 0), 1.0))
+        elif self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if method != "getMe" and self.p429 and random.random() < self.p429:
+            self.throttled[method] = self.throttled.get(method, 0) + 1
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                 "parameters": {"retry_after": self.retry_after}},
+                status=429,
+            )
+        return web.json_response({"ok": True, "result": self.result_for(method, params)})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": self.calls, "throttled": self.throttled})
+
+    def make_app(self) -> web.Application:
+        webapp = web.Application()
+        webapp.router.add_route("*", "/bot{token}/{method}", self.handle)
+        webapp.router.add_get("/stats", self.stats)
+        return webapp
+
+
+async def start(api: FakeBotApi, host: str = "127.0.0.1", port: int = 8081) -> web.AppRunner:
+    runner = web.AppRunner(api.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="میانگین تأخیر هر درخواست")
+    ap.add_argument("--jitter-ms", type=float, default=0.0, help="انحراف معیار تأخیر")
+    ap.add_argument("--p429", type=float, default=0.0, help="احتمال پاسخ 429 برای هر درخواست")
+    ap.add_argument("--retry-after", type=int, default=1)
+    args = ap.parse_args()
+
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.p429, args.retry_after)
+    web.run_app(api.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
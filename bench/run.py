@@ -0,0 +1,226 @@
+# bench/run.py
+# -*- coding: utf-8 -*-
+"""بنچمارک سرتاسری: هندلرهای main.py روی Postgres محلی و Bot API جعلی.
+
+    createdb najnaj_bench
+    python bench/run.py --db postgresql://localhost/najnaj_bench --n 20000 --latency-ms 30
+    python bench/run.py --db ... --trace trace.jsonl --out bench_output.txt
+
+دیتابیس داده‌ی آزمایشی می‌گیرد؛ از دیتابیس جدا استفاده کنید.
+خروجی: توان عملیاتی، p50/p99 زمان هندلر و انتظار در صف به تفکیک نوع آپدیت، تعداد کوئری و
+گرفتن اتصال به ازای هر آپدیت (از _db_metrics) و فراخوانی‌های Bot API.
+نکته: inline_query فقط تسک پاسخ را می‌سازد؛ زمان پاسخ‌دهی در answerInlineQuery دیده می‌شود.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+
+def _pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default=os.environ.get("DATABASE_URL", ""), help="DATABASE_URL یک Postgres محلی")
+    ap.add_argument("--trace", help="فایل JSONL ساخته‌شده با traces.py؛ اگر نباشد همین‌جا ساخته می‌شود")
+    ap.add_argument("--n", type=int, default=5000)
+    ap.add_argument("--groups", type=int, default=50)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--mix", default=None)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--inflight", type=int, default=256, help="حداکثر آپدیت تزریق‌شده‌ی هم‌زمان")
+    ap.add_argument("--port", type=int, default=18081, help="پورت Bot API جعلی")
+    ap.add_argument("--latency-ms", type=float, default=20.0)
+    ap.add_argument("--jitter-ms", type=float, default=5.0)
+    ap.add_argument("--p429", type=float, default=0.0)
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--out", help="علاوه بر stdout در این فایل هم نوشته شود")
+    args = ap.parse_args()
+    if not args.db:
+        raise SystemExit("--db یا DATABASE_URL لازم است.")
+    return args
+
+
+def configure_env(args):
+    # باید پیش از import main انجام شود چون تنظیمات در سطح ماژول خوانده می‌شوند
+    os.environ["DATABASE_URL"] = args.db
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    os.environ.setdefault("ADMIN_ID", "999999999")
+    os.environ.setdefault("CHANNEL_USERNAME", "bench_channel")
+    os.environ["BOT_API_BASE_URL"] = f"http://127.0.0.1:{args.port}/bot"
+    os.environ.pop("WEBHOOK_URL", None)
+    os.environ.pop("METRICS_PORT", None)
+
+
+def load_updates(args) -> list:
+    if args.trace:
+        with open(args.trace, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    from traces import TraceGen, parse_mix, DEFAULT_MIX
+    gen = TraceGen(args.groups, args.users, args.seed)
+    return list(gen.generate(args.n, parse_mix(args.mix or DEFAULT_MIX)))
+
+
+async def run(args) -> str:
+    import asyncpg
+    import main
+    from telegram import Update
+    from fake_bot_api import FakeBotApi, start as start_fake_api
+
+    api = FakeBotApi(args.latency_ms, args.jitter_ms, args.p429, args.retry_after)
+    api_runner = await start_fake_api(api, port=args.port)
+
+    # شمارش کوئری‌ها روی همهٔ اتصال‌های pool
+    queries = [0]
+    init_connection = main._init_connection
+
+    async def counting_init(con):
+        await init_connection(con)
+        con.add_query_logger(lambda _record: queries.__setitem__(0, queries[0] + 1))
+    main._init_connection = counting_init
+
+    app = main.build_application()
+    await app.initialize()
+    await main.post_init(app)
+    await app.start()
+
+    raw_updates = load_updates(args)
+    async with main.db("bench") as con:
+        base_wid = await con.fetchval(
+            "SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM whispers_id_seq;"
+        )
+
+    # شناسه‌ها هم‌زمان گرفته می‌شوند، پس k-امین نجوای trace لزوماً base_wid + k نیست؛ کلیک پس از پردازش
+    # پیام خصوصی سازنده، شناسهٔ واقعی را با (فرستنده، گیرنده، متن) از یک pool جدا (بیرون از شمارش) پیدا می‌کند
+    lookup = await asyncpg.create_pool(args.db, min_size=1, max_size=4)
+    creators: dict = {}  # k -> (task, sender, receiver, text)
+
+    async def resolve_show(k: int) -> str:
+        creator = creators.get(k)
+        if creator is None:  # trace قدیمی بدون _bench_whisper
+            return f"showid:{base_wid + k}"
+        task, sender, receiver, text = creator
+        await asyncio.gather(task, return_exceptions=True)
+        row = await lookup.fetchrow(
+            "SELECT id, created_at FROM whispers WHERE sender_id=$1 AND receiver_id=$2 AND text=$3 AND id > $4 ORDER BY id DESC LIMIT 1;",
+            sender, receiver, text, base_wid
+        )
+        if row is None:
+            return "showid:0"
+        return f"showid:{row['id']}:{main.whisper_month_key(row['created_at'])}"
+
+    handler_lat: dict = {}  # kind -> [seconds]
+    total_lat: dict = {}
+    db_before = {site: m.hold.count for site, m in main._db_metrics.items()}
+    q_before = queries[0]
+    api_before = dict(api.calls)
+    slots = asyncio.Semaphore(args.inflight)
+
+    async def one(raw):
+        try:
+            cq = raw.get("callback_query")
+            if cq and cq.get("data", "").startswith("showid:#"):
+                cq["data"] = await resolve_show(int(cq["data"][8:]))
+            update = Update.de_json(raw, app.bot)
+        except BaseException:
+            slots.release()
+            raise
+        kind = main._update_kind(update)
+        t0 = time.perf_counter()
+
+        async def timed():
+            t1 = time.perf_counter()
+            try:
+                await app.process_update(update)
+            finally:
+                handler_lat.setdefault(kind, []).append(time.perf_counter() - t1)
+        try:
+            await app.update_processor.process_update(update, timed())
+        finally:
+            total_lat.setdefault(kind, []).append(time.perf_counter() - t0)
+            slots.release()
+
+    started = time.perf_counter()
+    tasks = []
+    for raw in raw_updates:
+        marker = raw.pop("_bench_whisper", None)
+        await slots.acquire()
+        task = asyncio.get_running_loop().create_task(one(raw))
+        tasks.append(task)
+        if marker:
+            msg = raw["message"]
+            creators[marker["k"]] = (task, msg["from"]["id"], marker["receiver"], msg["text"])
+    await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+
+    # تخلیهٔ کارهای پس‌زمینه: پاسخ‌های اینلاین و بافر write-behind.
+    # صف گزارش عمداً منتظر نمی‌ماند (محدودیت نرخ هر چت آن را کند می‌کند)؛ فقط عمقش گزارش می‌شود.
+    drain_start = time.perf_counter()
+    pending_inline = [t for t in main._inline_tasks.values() if not t.done()]
+    if pending_inline:
+        await asyncio.gather(*pending_inline, return_exceptions=True)
+    await main.flush_writes()
+    drain = time.perf_counter() - drain_start
+    report_backlog = main.report_queue_depth()
+
+    n = len(raw_updates)
+    acquires = {site: m.hold.count - db_before.get(site, 0) for site, m in main._db_metrics.items()}
+    api_calls = {m: c - api_before.get(m, 0) for m, c in api.calls.items() if c - api_before.get(m, 0)}
+
+    lines = [
+        f"updates: {n} | elapsed: {elapsed:.2f}s | throughput: {n / elapsed:.1f} upd/s | drain: {drain:.2f}s",
+        f"fake api: latency {args.latency_ms:.0f}±{args.jitter_ms:.0f} ms | p429 {args.p429} | inflight {args.inflight}"
+        f" | UPDATE_CONCURRENCY {main.UPDATE_CONCURRENCY}",
+        "",
+        f"{'kind':<22}{'count':>8}{'handler p50':>14}{'p99':>10}{'total p50':>12}{'p99':>10}  (ms)",
+    ]
+    for kind in sorted(handler_lat):
+        h, t = handler_lat[kind], total_lat.get(kind, [])
+        lines.append(
+            f"{kind:<22}{len(h):>8}{_pct(h, 0.5) * 1000:>14.1f}{_pct(h, 0.99) * 1000:>10.1f}"
+            f"{_pct(t, 0.5) * 1000:>12.1f}{_pct(t, 0.99) * 1000:>10.1f}"
+        )
+    lines += [
+        "",
+        f"db queries: {queries[0] - q_before} ({(queries[0] - q_before) / max(n, 1):.2f}/update)"
+        f" | pool acquires: {sum(acquires.values())} ({sum(acquires.values()) / max(n, 1):.2f}/update)",
+    ]
+    for site, c in sorted(acquires.items(), key=lambda kv: -kv[1]):
+        if c:
+            lines.append(f"  {site:<30}{c:>8}")
+    lines += ["", f"bot api calls: {sum(api_calls.values())} ({sum(api_calls.values()) / max(n, 1):.2f}/update)"
+              f" | 429 injected: {sum(api.throttled.values())} | report backlog: {report_backlog}"]
+    for method, c in sorted(api_calls.items(), key=lambda kv: -kv[1]):
+        lines.append(f"  {method:<30}{c:>8}")
+
+    await app.stop()
+    await main.post_shutdown(app)
+    await app.shutdown()
+    await lookup.close()
+    await api_runner.cleanup()
+    return "\n".join(lines)
+
+
+def main():
+    args = parse_args()
+    configure_env(args)
+    report = asyncio.run(run(args))
+    print(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# bench/traces.py
+# -*- coding: utf-8 -*-
+"""تولید جریان آپدیت مصنوعی (JSONL، هر خط یک Update خام Bot API) برای بنچمارک.
+
+    python bench/traces.py --n 20000 --groups 50 --users 2000 --out trace.jsonl
+
+انواع آپدیت (نسبت‌ها با --mix):
+  chatter  پیام معمولی در گروه (گاهی ریپلای)
+  trigger  ریپلای «نجوا» در گروه و سپس متن نجوا در خصوصی فرستنده
+  inline   چند کلید زدن پشت سر هم در حالت اینلاین
+  show     کلیک روی دکمهٔ showid: (شناسه به شکل «#k» یعنی k-امین نجوای همین اجرا؛ run.py آن را جایگزین می‌کند)
+
+پیام خصوصیِ سازندهٔ نجوای k کلید اضافی «_bench_whisper» دارد تا run.py شناسهٔ واقعی را پس از پردازش آن پیدا کند.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+
+WORDS = ["سلام", "خوبی", "چه خبر", "امروز", "فردا", "کجایی", "باشه", "مرسی", "عالیه", "ok", "lol", "😂", "👍"]
+TRIGGER_WORDS = ["نجوا", "درگوشی", "سکرت"]
+DEFAULT_MIX = "chatter=0.75,trigger=0.08,inline=0.12,show=0.05"
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"bench_u{uid}"}
+
+
+class TraceGen:
+    def __init__(self, groups: int, users: int, seed: int):
+        self.rnd = random.Random(seed)
+        self.group_ids = [-1001000000000 - i for i in range(groups)]
+        self.user_ids = [100000 + i for i in range(users)]
+        self.update_id = 0
+        self.message_id = 0
+        self.whispers = []  # (sender, receiver) به ترتیب ایجاد
+        self.now = int(time.time())
+
+    def _next(self, **payload) -> dict:
+        self.update_id += 1
+        return {"update_id": self.update_id, **payload}
+
+    def _message(self, chat: dict, uid: int, text: str, reply_to: dict | None = None) -> dict:
+        self.message_id += 1
+        msg = {"message_id": self.message_id, "date": self.now, "chat": chat, "from": _user(uid), "text": text}
+        if reply_to is not None:
+            msg["reply_to_message"] = reply_to
+        return msg
+
+    def _group(self) -> dict:
+        gid = self.rnd.choice(self.group_ids)
+        return {"id": gid, "type": "supergroup", "title": f"گروه بنچ {gid}"}
+
+    def _two_users(self):
+        a, b = self.rnd.sample(self.user_ids, 2)
+        return a, b
+
+    def chatter(self):
+        chat = self._group()
+        a, b = self._two_users()
+        text = " ".join(self.rnd.choice(WORDS) for _ in range(self.rnd.randint(1, 6)))
+        reply_to = self._message(chat, b, self.rnd.choice(WORDS)) if self.rnd.random() < 0.3 else None
+        yield self._next(message=self._message(chat, a, text, reply_to))
+
+    def trigger(self):
+        chat = self._group()
+        sender, receiver = self._two_users()
+        target = self._message(chat, receiver, self.rnd.choice(WORDS))
+        yield self._next(message=self._message(chat, sender, self.rnd.choice(TRIGGER_WORDS), target))
+        private = {"id": sender, "type": "private", "first_name": f"user{sender}"}
+        text = "نجوای بنچ " + " ".join(self.rnd.choice(WORDS) for _ in range(self.rnd.randint(2, 12)))
+        self.whispers.append((sender, receiver))
+        yield self._next(message=self._message(private, sender, text),
+                         _bench_whisper={"k": len(self.whispers), "receiver": receiver})
+
+    def inline(self):
+        uid = self.rnd.choice(self.user_ids)
+        peer = self.rnd.choice(self.user_ids)
+        full = "سلام " + " ".join(self.rnd.choice(WORDS) for _ in range(self.rnd.randint(0, 3)))
+        if self.rnd.random() < 0.5:
+            full += f" @bench_u{peer}"
+        # کلید زدن تدریجی؛ هر چند حرف یک کوئری
+        for end in range(1, len(full) + 1, self.rnd.randint(2, 4)):
+            yield self._next(inline_query={"id": str(self.update_id), "from": _user(uid), "query": full[:end], "offset": ""})
+        yield self._next(inline_query={"id": str(self.update_id), "from": _user(uid), "query": full, "offset": ""})
+
+    def show(self):
+        if not self.whispers:
+            return
+        k = self.rnd.randrange(len(self.whispers))
+        sender, receiver = self.whispers[k]
+        clicker = receiver if self.rnd.random() < 0.8 else self.rnd.choice(self.user_ids)
+        chat = self._group()
+        yield self._next(callback_query={
+            "id": str(self.update_id),
+            "from": _user(clicker),
+            "chat_instance": str(chat["id"]),
+            "data": f"showid:#{k + 1}",
+            "message": self._message(chat, 1, "🔒"),
+        })
+
+    def generate(self, n: int, mix: dict):
+        kinds = list(mix)
+        weights = [mix[k] for k in kinds]
+        produced = 0
+        while produced < n:
+            kind = self.rnd.choices(kinds, weights)[0]
+            for update in getattr(self, kind)():
+                yield update
+                produced += 1
+                if produced >= n:
+                    return
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("chatter", "trigger", "inline", "show"):
+            raise SystemExit(f"نوع ناشناخته در --mix: {kind}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--n", type=int, default=10000, help="تعداد آپدیت")
+    ap.add_argument("--groups", type=int, default=50)
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="-", help="مسیر خروجی JSONL (پیش‌فرض stdout)")
+    args = ap.parse_args()
+
+    gen = TraceGen(args.groups, args.users, args.seed)
+    out = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8")
+    try:
+        for update in gen.generate(args.n, parse_mix(args.mix)):
+            out.write(json.dumps(update, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,24 @@
 
 import os
 import re
+import io
+import gzip
+import json
+import hmac
+import time
+import signal
 import asyncio
+import pstats
+import cProfile
+import logging
+import functools
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from secrets import token_urlsafe
 from urllib.parse import quote as urlquote
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
 from telegram import (
     Update,
@@ -16,6 +30,7 @@ from telegram import (
     InlineQueryResultArticle,
 )
 from telegram.constants import ParseMode, ChatType
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
 from telegram.ext import (
     Application,
     ContextTypes,
@@ -26,8 +41,18 @@ from telegram.ext import (
     ChosenInlineResultHandler,
     ChatMemberHandler,
     filters,
+    BaseUpdateProcessor,
 )
+from telegram.request import HTTPXRequest
 import asyncpg
+from aiohttp import web
+
+try:
+    import yappi  # اختیاری؛ اگر نصب باشد پروفایل دقیق‌تر کوروتین‌ها
+except ImportError:
+    yappi = None
+
+log = logging.getLogger("najnaj1bot")
 
 # --------- تنظیمات از محیط ---------
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
@@ -53,13 +78,29 @@ if _norm(CHANNEL_USERNAME_2) and _norm(CHANNEL_USERNAME_2).lower() != _norm(CHAN
 
 # ---------- ثوابت ----------
 TRIGGERS = {"نجوا", "درگوشی", "سکرت"}
+HELP_WORDS = {"راهنما", "help", "Help"}
 KEEP_TRIGGER_MESSAGE = True  # ✅ پیام دستور در گروه پاک نشود
 GUIDE_DELETE_AFTER_SEC = 180
 ALERT_SNIPPET = 190
 
+# شناسهٔ همین نسخه (replica) برای lease کارها و نادیده گرفتن NOTIFYهای خودش
+INSTANCE_ID = token_urlsafe(8)
+
 # تاریخ خیلی دور برای «بدون انقضا»
 FAR_FUTURE = datetime(2099, 1, 1, tzinfo=timezone.utc)
 
+# ماندگاری داده‌ها (۰ = بدون انقضا)
+PENDING_TTL_SEC = int(os.environ.get("PENDING_TTL_SEC", "86400"))
+# ردیف‌های قدیمی reported=FALSE دارند حتی اگر خوانده شده باشند؛ پیش‌فرض ۰ تا دکمه‌های موجود در چت‌ها باطل نشوند.
+# انقضا با هر باز کردن نجوا جلو می‌رود (on_inline_show)، پس فقط نجواهای رهاشده پاک می‌شوند.
+INLINE_UNREPORTED_TTL_SEC = int(os.environ.get("INLINE_UNREPORTED_TTL_SEC", "0"))
+INLINE_REPORTED_TTL_SEC = int(os.environ.get("INLINE_REPORTED_TTL_SEC", str(90 * 86400)))
+READ_WHISPER_TTL_DAYS = int(os.environ.get("READ_WHISPER_TTL_DAYS", "90"))
+BROADCAST_TTL_DAYS = int(os.environ.get("BROADCAST_TTL_DAYS", "30"))
+
+def expires_in(seconds: int) -> datetime:
+    return FAR_FUTURE if seconds <= 0 else datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
 broadcast_wait_for_banner = set()
 
 # ---------- ابزارک‌های عمومی ----------
@@ -72,9 +113,90 @@ def mention_html(user_id: int, name: str) -> str:
 def group_link_title(title: str) -> str:
     return sanitize(title or "گروه")
 
+@functools.lru_cache(maxsize=4096)
 def avatar_url(label: str) -> str:
     return f"https://api.dicebear.com/7.x/initials/svg?seed={urlquote(label or 'user')}"
 
+class TTLCache:
+    """LRU کوچک با انقضای جداگانه برای هر کلید."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, exp = item
+        if exp < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key, value, ttl: float | None = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_MISSING = object()
+
+# کارهای پس‌زمینه به ترتیب راه‌اندازی؛ stop_background آن‌ها را به ترتیب عکس می‌بندد
+_background: list = []  # [(name, Task)]
+
+def spawn_background(name: str, coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro, name=name)
+    _background.append((name, task))
+    return task
+
+async def stop_background():
+    while _background:
+        _, task = _background.pop()
+        task.cancel()
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """هیستوگرام با سطل‌های ثابت (سازگار با قالب Prometheus)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+        return self.buckets[-1]
+
 async def safe_delete(bot, chat_id: int, message_id: int, attempts: int = 3, delay: float = 0.6):
     for _ in range(attempts):
         try:
@@ -84,16 +206,96 @@ async def safe_delete(bot, chat_id: int, message_id: int, attempts: int = 3, del
             await asyncio.sleep(delay)
     return False
 
-# --- زمان‌بندی بدون JobQueue (با asyncio) ---
-async def _delete_after(bot, chat_id: int, message_id: int, delay_sec: int):
-    try:
-        await asyncio.sleep(delay_sec)
-        await bot.delete_message(chat_id, message_id)
-    except Exception:
-        pass
+# --- صف ماندگار حذف پیام‌ها (جدول scheduled_deletes + یک worker) ---
+DELETE_BATCH = int(os.environ.get("DELETE_BATCH", "50"))
+DELETE_CONCURRENCY = int(os.environ.get("DELETE_CONCURRENCY", "5"))
+DELETE_IDLE_SEC = float(os.environ.get("DELETE_IDLE_SEC", "60"))
+# ردیف برداشته‌شده تا این مدت قفل می‌ماند و فقط پس از پاسخ قطعی API حذف می‌شود؛ اگر worker بمیرد دوباره برداشته می‌شود
+DELETE_LEASE_SEC = float(os.environ.get("DELETE_LEASE_SEC", "120"))
+DELETE_RETRY_SEC = float(os.environ.get("DELETE_RETRY_SEC", "30"))
+
+_delete_wakeup: asyncio.Event | None = None
+_delete_next_due: float = 0.0  # زمان (epoch) بیدارشدن بعدی worker
+
+async def schedule_delete(chat_id: int, message_id: int, delay_sec: int):
+    async with db("schedule_delete") as con:
+        await con.execute(
+            """INSERT INTO scheduled_deletes (chat_id, message_id, due_at)
+               VALUES ($1,$2,NOW() + make_interval(secs => $3))
+               ON CONFLICT (chat_id, message_id) DO UPDATE SET due_at=EXCLUDED.due_at;""",
+            chat_id, message_id, float(delay_sec)
+        )
+    if _delete_wakeup is not None and time.time() + delay_sec < _delete_next_due:
+        _delete_wakeup.set()
+
+async def _delete_worker(bot):
+    global _delete_next_due
+    sem = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def one(chat_id: int, message_id: int):
+        # None = تمام (حذف شد یا هرگز حذف‌شدنی نیست)، عدد = چند ثانیه بعد دوباره
+        async with sem:
+            try:
+                await bot.delete_message(chat_id, message_id)
+            except RetryAfter as e:
+                return chat_id, message_id, float(e.retry_after)
+            except (BadRequest, Forbidden):
+                pass
+            except NetworkError:
+                return chat_id, message_id, DELETE_RETRY_SEC
+            except Exception:
+                pass
+            return chat_id, message_id, None
 
-def schedule_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, delay_sec: int):
-    context.application.create_task(_delete_after(context.bot, chat_id, message_id, delay_sec))
+    while True:
+        _delete_wakeup.clear()
+        try:
+            async with db("_delete_worker") as con:
+                rows = await con.fetch(
+                    """UPDATE scheduled_deletes SET due_at = NOW() + make_interval(secs => $2)
+                       WHERE (chat_id, message_id) IN (
+                         SELECT chat_id, message_id FROM scheduled_deletes
+                         WHERE due_at<=NOW() ORDER BY due_at LIMIT $1 FOR UPDATE SKIP LOCKED)
+                       RETURNING chat_id, message_id;""",
+                    DELETE_BATCH, DELETE_LEASE_SEC
+                )
+                nxt = 0.0 if len(rows) >= DELETE_BATCH else await con.fetchval(
+                    "SELECT EXTRACT(EPOCH FROM MIN(due_at) - NOW())::float8 FROM scheduled_deletes;"
+                )
+        except Exception:
+            rows, nxt = [], 5.0
+        if rows:
+            results = await asyncio.gather(*(one(int(r["chat_id"]), int(r["message_id"])) for r in rows))
+            done = [(c, m) for c, m, retry in results if retry is None]
+            retry = [(c, m, retry) for c, m, retry in results if retry is not None]
+            try:
+                async with db("_delete_worker") as con:
+                    if done:
+                        await con.execute(
+                            """DELETE FROM scheduled_deletes WHERE (chat_id, message_id) IN (
+                                 SELECT * FROM UNNEST($1::bigint[], $2::bigint[]))""",
+                            [c for c, _ in done], [m for _, m in done]
+                        )
+                    if retry:
+                        await con.executemany(
+                            "UPDATE scheduled_deletes SET due_at = NOW() + make_interval(secs => $3) WHERE chat_id=$1 AND message_id=$2;",
+                            retry
+                        )
+                        nxt = min(nxt if nxt is not None else DELETE_IDLE_SEC, min(r[2] for r in retry))
+            except Exception:
+                pass  # ردیف‌ها پس از پایان lease دوباره برداشته می‌شوند
+        wait = DELETE_IDLE_SEC if nxt is None else min(max(0.0, nxt), DELETE_IDLE_SEC)
+        _delete_next_due = time.time() + wait
+        if wait > 0:
+            try:
+                await asyncio.wait_for(_delete_wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+def start_delete_worker(bot):
+    global _delete_wakeup
+    _delete_wakeup = asyncio.Event()
+    spawn_background("delete", _delete_worker(bot))
 
 # ---------- دیتابیس ----------
 pool: asyncpg.Pool = None
@@ -114,20 +316,6 @@ CREATE TABLE IF NOT EXISTS chats (
   last_seen TIMESTAMPTZ DEFAULT NOW()
 );
 
-CREATE TABLE IF NOT EXISTS whispers (
-  id BIGSERIAL PRIMARY KEY,
-  group_id BIGINT NOT NULL,
-  sender_id BIGINT NOT NULL,
-  receiver_id BIGINT NOT NULL,
-  text TEXT NOT NULL,
-  status TEXT NOT NULL DEFAULT 'sent',
-  created_at TIMESTAMPTZ DEFAULT NOW(),
-  message_id INTEGER
-);
-
-CREATE INDEX IF NOT EXISTS idx_whispers_group ON whispers(group_id);
-CREATE INDEX IF NOT EXISTS idx_whispers_sr ON whispers(sender_id, receiver_id);
-
 CREATE TABLE IF NOT EXISTS pending (
   sender_id BIGINT PRIMARY KEY,
   group_id BIGINT NOT NULL,
@@ -175,25 +363,342 @@ ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS receiver_username TEXT;
 ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS reported BOOLEAN NOT NULL DEFAULT FALSE;
 """
 
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", "1024"))  # برای pgbouncer حالت transaction: 0
+DB_STATEMENT_LIFETIME = float(os.environ.get("DB_STATEMENT_LIFETIME", "300"))
+DB_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", "30"))
+
+async def _init_connection(con):
+    # کوئری‌ها کوچک و OLTP هستند؛ JIT فقط تأخیر اضافه می‌کند
+    await con.execute("SET jit = off;")
+
+# جدول whispers به‌صورت ماهانه بر اساس created_at پارتیشن می‌شود
+WHISPERS_SQL = """
+CREATE SEQUENCE IF NOT EXISTS whispers_id_seq;
+
+CREATE TABLE IF NOT EXISTS whispers (
+  id BIGINT NOT NULL DEFAULT nextval('whispers_id_seq'),
+  group_id BIGINT NOT NULL,
+  sender_id BIGINT NOT NULL,
+  receiver_id BIGINT NOT NULL,
+  text TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'sent',
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  message_id INTEGER,
+  PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE INDEX IF NOT EXISTS idx_whispers_group ON whispers(group_id);
+CREATE INDEX IF NOT EXISTS idx_whispers_sr ON whispers(sender_id, receiver_id);
+CREATE INDEX IF NOT EXISTS idx_whispers_cb ON whispers(group_id, message_id, sender_id, receiver_id, id) INCLUDE (status);
+CREATE INDEX IF NOT EXISTS idx_whispers_read_created ON whispers(created_at) WHERE status='read';
+"""
+
+WHISPER_PARTITIONS_AHEAD = int(os.environ.get("WHISPER_PARTITIONS_AHEAD", "2"))
+WHISPER_PARTITION_KEEP_MONTHS = int(os.environ.get("WHISPER_PARTITION_KEEP_MONTHS", "0"))  # ۰ = هیچ پارتیشنی جدا نشود
+WHISPER_PARTITION_DROP = os.environ.get("WHISPER_PARTITION_DROP", "0") == "1"
+
+def _month_start(d: datetime) -> datetime:
+    return datetime(d.year, d.month, 1, tzinfo=timezone.utc)
+
+def _next_month(d: datetime) -> datetime:
+    return datetime(d.year + (d.month == 12), d.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+# ماه ساخت نجوا در callback_data می‌آید تا جست‌وجو با id فقط یک پارتیشن را ببیند
+def whisper_month_key(created_at: datetime) -> str:
+    return f"{created_at.astimezone(timezone.utc):%Y%m}"
+
+def whisper_month_range(key: str | None) -> tuple:
+    if not key:
+        # دکمه‌های قدیمی «showid:<id>» ماه ندارند
+        return datetime(1970, 1, 1, tzinfo=timezone.utc), FAR_FUTURE
+    start = datetime(int(key[:4]), int(key[4:6]), 1, tzinfo=timezone.utc)
+    return start, _next_month(start)
+
+WHISPER_PARTITION_LOCK_KEY = 7_236_115_002
+
+async def ensure_whisper_partitions(con, since: datetime | None = None):
+    now = datetime.now(timezone.utc)
+    m = _month_start(since or now)
+    last = _month_start(now)
+    for _ in range(max(1, WHISPER_PARTITIONS_AHEAD)):
+        last = _next_month(last)
+    # چند replica ممکن است هم‌زمان همین کار را بکنند؛ قفل تا پایان تراکنش نگه داشته می‌شود
+    async with con.transaction():
+        await con.execute("SELECT pg_advisory_xact_lock($1);", WHISPER_PARTITION_LOCK_KEY)
+        while m <= last:
+            nxt = _next_month(m)
+            await con.execute(
+                f"CREATE TABLE IF NOT EXISTS whispers_{m:%Y%m} PARTITION OF whispers "
+                f"FOR VALUES FROM ('{m.isoformat()}') TO ('{nxt.isoformat()}');"
+            )
+            m = nxt
+
+async def write_whisper(con, method: str, query: str, *args):
+    """نوشتن در whispers؛ اگر پارتیشن ماه جاری هنوز ساخته نشده باشد (worker نگهداری نرسیده) می‌سازد و یک بار دوباره می‌زند."""
+    try:
+        return await getattr(con, method)(query, *args)
+    except asyncpg.CheckViolationError as e:
+        if "no partition" not in str(e):
+            raise
+        await ensure_whisper_partitions(con)
+        return await getattr(con, method)(query, *args)
+
+async def migrate_whispers_partitioned(con):
+    kind = await con.fetchval("SELECT relkind FROM pg_class WHERE oid = to_regclass('whispers');")
+    if kind in (b"p", "p"):
+        return
+    async with con.transaction():
+        since = None
+        if kind is not None:
+            # تبدیل جدول قدیمی: تغییر نام، ساخت جدول پارتیشن‌شده و انتقال ردیف‌ها
+            await con.execute("LOCK TABLE whispers IN ACCESS EXCLUSIVE MODE;")
+            await con.execute("ALTER TABLE whispers RENAME TO whispers_legacy;")
+            await con.execute("ALTER TABLE whispers_legacy RENAME CONSTRAINT whispers_pkey TO whispers_legacy_pkey;")
+            await con.execute("DROP INDEX IF EXISTS idx_whispers_group, idx_whispers_sr, idx_whispers_read_created;")
+            await con.execute("ALTER SEQUENCE IF EXISTS whispers_id_seq OWNED BY NONE;")
+            since = await con.fetchval("SELECT MIN(created_at) FROM whispers_legacy;")
+        await con.execute(WHISPERS_SQL)
+        await ensure_whisper_partitions(con, since)
+        if kind is not None:
+            await con.execute(
+                """INSERT INTO whispers (id, group_id, sender_id, receiver_id, text, status, created_at, message_id)
+                   SELECT id, group_id, sender_id, receiver_id, text, status, COALESCE(created_at, NOW()), message_id
+                   FROM whispers_legacy;"""
+            )
+            await con.execute("DROP TABLE whispers_legacy;")
+
+async def detach_old_whisper_partitions(con):
+    if WHISPER_PARTITION_KEEP_MONTHS <= 0:
+        return
+    cutoff = _month_start(datetime.now(timezone.utc))
+    for _ in range(WHISPER_PARTITION_KEEP_MONTHS):
+        cutoff = _month_start(cutoff - timedelta(days=1))
+    rows = await con.fetch(
+        """SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'whispers'::regclass AND c.relname ~ '^whispers_[0-9]{6}$';"""
+    )
+    for r in rows:
+        name = r["relname"]
+        start = datetime(int(name[9:13]), int(name[13:15]), 1, tzinfo=timezone.utc)
+        if _next_month(start) <= cutoff:
+            await con.execute(f"ALTER TABLE whispers DETACH PARTITION {name};")
+            if WHISPER_PARTITION_DROP:
+                await con.execute(f"DROP TABLE {name};")
+
+# ---------- مهاجرت‌های نسخه‌دار ----------
+# هر گام فقط یک بار اجرا و در schema_version ثبت می‌شود؛ گام‌ها را فقط به انتها اضافه کنید.
+MIGRATION_LOCK_KEY = 7_236_115_001  # کلید advisory lock مشترک بین نسخه‌های هم‌زمان
+
+def concurrent_index(name: str, definition: str):
+    """گام CREATE INDEX CONCURRENTLY (بیرون از تراکنش). ایندکس نیمه‌کارهٔ قبلی اول حذف می‌شود."""
+    async def step(con):
+        invalid = await con.fetchval(
+            "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname=$1;",
+            name
+        )
+        if invalid:
+            await con.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        await con.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition};")
+    step.concurrent = True
+    return step
+
+MIGRATIONS = [
+    (1, "baseline", CREATE_SQL + ALTER_SQL),
+    (2, "users username index", concurrent_index("idx_users_username_lower", "users (lower(username))")),
+    (3, "scheduled deletes", """
+CREATE TABLE IF NOT EXISTS scheduled_deletes (
+  chat_id BIGINT NOT NULL,
+  message_id BIGINT NOT NULL,
+  due_at TIMESTAMPTZ NOT NULL,
+  PRIMARY KEY (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS idx_scheduled_deletes_due ON scheduled_deletes(due_at);
+"""),
+    (4, "broadcast jobs", """
+ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked BOOLEAN NOT NULL DEFAULT FALSE;
+
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+  id BIGSERIAL PRIMARY KEY,
+  kind TEXT NOT NULL,
+  from_chat_id BIGINT,
+  message_id BIGINT,
+  body TEXT,
+  status TEXT NOT NULL DEFAULT 'running',
+  admin_chat_id BIGINT NOT NULL,
+  progress_msg_id BIGINT,
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  finished_at TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS broadcast_targets (
+  job_id BIGINT NOT NULL,
+  chat_id BIGINT NOT NULL,
+  state TEXT NOT NULL DEFAULT 'pending',
+  PRIMARY KEY (job_id, chat_id)
+);
+"""),
+    (5, "daily stats", """
+CREATE TABLE IF NOT EXISTS stats_daily (
+  day DATE NOT NULL,
+  kind TEXT NOT NULL,
+  n BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, kind)
+);
+"""),
+    (6, "group metadata", """
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS member_count INTEGER;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS owner_id BIGINT;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS owner_name TEXT;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS meta_at TIMESTAMPTZ;
+"""),
+    (7, "iwhispers expiry index", concurrent_index("idx_iwhispers_expires", "iwhispers (expires_at)")),
+    (8, "pending expiry index", concurrent_index("idx_pending_expires", "pending (expires_at)")),
+    (9, "partitioned whispers", migrate_whispers_partitioned),
+    (10, "iwhispers inline message owner", "ALTER TABLE iwhispers ADD COLUMN IF NOT EXISTS inline_message_id TEXT;"),
+    (11, "broadcast job lease", """
+ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS lease_until TIMESTAMPTZ;
+"""),
+    (12, "iwhispers inline message index",
+     concurrent_index("idx_iwhispers_inline_message", "iwhispers (inline_message_id) WHERE inline_message_id IS NOT NULL")),
+    (13, "shared inline drafts", """
+CREATE TABLE IF NOT EXISTS inline_drafts (
+  token TEXT PRIMARY KEY,
+  sender_id BIGINT NOT NULL,
+  receiver_id BIGINT,
+  receiver_username TEXT,
+  text TEXT NOT NULL,
+  expires_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_inline_drafts_expires ON inline_drafts(expires_at);
+"""),
+]
+
+async def _schema_version(con) -> int:
+    try:
+        return await con.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def run_migrations(con):
+    await con.execute("SELECT pg_advisory_lock($1);", MIGRATION_LOCK_KEY)
+    try:
+        await con.execute(
+            """CREATE TABLE IF NOT EXISTS schema_version (
+                 version INTEGER PRIMARY KEY,
+                 name TEXT NOT NULL,
+                 applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+               );"""
+        )
+        current = await _schema_version(con)
+        for version, name, step in MIGRATIONS:
+            if version <= current:
+                continue
+            if getattr(step, "concurrent", False):
+                await step(con)
+                await con.execute("INSERT INTO schema_version (version, name) VALUES ($1,$2);", version, name)
+                continue
+            async with con.transaction():
+                if isinstance(step, str):
+                    await con.execute(step)
+                else:
+                    await step(con)
+                await con.execute("INSERT INTO schema_version (version, name) VALUES ($1,$2);", version, name)
+    finally:
+        await con.execute("SELECT pg_advisory_unlock($1);", MIGRATION_LOCK_KEY)
+
 async def init_db():
     global pool
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_cached_statement_lifetime=DB_STATEMENT_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        init=_init_connection,
+        server_settings={"application_name": "najnaj1bot"},
+    )
+    # مسیر سریع: اگر اسکیمای دیتابیس به‌روز است فقط یک کوئری نسخه اجرا می‌شود
     async with pool.acquire() as con:
-        await con.execute(CREATE_SQL)
-        await con.execute(ALTER_SQL)
-
-async def upsert_user(u):
+        current = await _schema_version(con)
+    if current < MIGRATIONS[-1][0]:
+        # اتصال جدا و بدون command_timeout، چون ساخت ایندکس هم‌زمان ممکن است طول بکشد
+        con = await asyncpg.connect(DATABASE_URL)
+        try:
+            await run_migrations(con)
+        finally:
+            await con.close()
+    # پارتیشن ماه جاری و بعدی در هر شروع؛ به worker نگهداری وابسته نیست
     async with pool.acquire() as con:
+        await ensure_whisper_partitions(con)
+
+# --- متریک‌های دیتابیس به تفکیک محل فراخوانی ---
+class DbSiteMetrics:
+    def __init__(self):
+        self.wait = Histogram()   # انتظار برای گرفتن اتصال
+        self.hold = Histogram()   # مدت استفاده از اتصال (زمان کوئری)
+        self.errors = 0
+
+_db_metrics: dict = {}  # site -> DbSiteMetrics
+_db_in_use = 0
+
+@asynccontextmanager
+async def db(site: str):
+    global _db_in_use
+    m = _db_metrics.get(site)
+    if m is None:
+        m = _db_metrics[site] = DbSiteMetrics()
+    prof = _update_profile.get()
+    t0 = time.perf_counter()
+    async with pool.acquire() as con:
+        t1 = time.perf_counter()
+        m.wait.observe(t1 - t0)
+        _db_in_use += 1
+        try:
+            yield con
+        except Exception:
+            m.errors += 1
+            raise
+        finally:
+            _db_in_use -= 1
+            t2 = time.perf_counter()
+            m.hold.observe(t2 - t1)
+            if prof is not None:
+                prof["db"] += t2 - t0
+
+def db_metrics_text() -> str:
+    lines = [
+        f"🗄 استخر اتصال: {pool.get_size()}/{DB_POOL_MAX} | بیکار: {pool.get_idle_size()} | در حال استفاده: {_db_in_use}",
+        "محل — تعداد | انتظار p50/p99 | کوئری p50/p99 (ms) | خطا",
+    ]
+    for site, m in sorted(_db_metrics.items(), key=lambda kv: kv[1].hold.sum, reverse=True):
+        lines.append(
+            f"{site} — {m.hold.count} | {m.wait.quantile(0.5) * 1000:.0f}/{m.wait.quantile(0.99) * 1000:.0f}"
+            f" | {m.hold.quantile(0.5) * 1000:.0f}/{m.hold.quantile(0.99) * 1000:.0f} | {m.errors}"
+        )
+    return "\n".join(lines)
+
+async def upsert_user(u, unblock: bool = False):
+    _remember_username(u.id, u.username)
+    _remember_profile(u)
+    async with db("upsert_user") as con:
         await con.execute(
             """INSERT INTO users (user_id, username, first_name, last_seen)
                VALUES ($1,$2,$3,NOW())
                ON CONFLICT (user_id) DO UPDATE SET
-                 username=EXCLUDED.username, first_name=EXCLUDED.first_name, last_seen=NOW();""",
-            u.id, u.username, u.first_name or u.full_name
+                 username=EXCLUDED.username, first_name=EXCLUDED.first_name, last_seen=NOW(),
+                 blocked=users.blocked AND NOT $4;""",
+            u.id, u.username, u.first_name or u.full_name, unblock
         )
 
 async def upsert_chat(c, active: bool = True):
-    async with pool.acquire() as con:
+    _remember_chat(c)
+    if not active:
+        forget_buffered_chat(c.id)
+    async with db("upsert_chat") as con:
         await con.execute(
             """INSERT INTO chats (chat_id, title, type, is_active, last_seen)
                VALUES ($1,$2,$3,$4,NOW())
@@ -202,54 +707,147 @@ async def upsert_chat(c, active: bool = True):
             c.id, getattr(c, "title", None), c.type, active
         )
 
+# --- کش عنوان گروه‌ها: حافظه ← جدول chats ← Bot API ---
+CHAT_TITLE_TTL = float(os.environ.get("CHAT_TITLE_TTL", "21600"))
+_chat_titles = TTLCache(int(os.environ.get("CHAT_TITLE_CACHE_MAX", "20000")), CHAT_TITLE_TTL)
+
+def _remember_chat(c):
+    title = getattr(c, "title", None)
+    if title:
+        _chat_titles.set(c.id, title)
+
+async def get_chat_title(bot, chat_id: int, fallback: str = "گروه") -> str:
+    title = _chat_titles.get(chat_id)
+    if title is not None:
+        return title or fallback
+    async with db("get_chat_title") as con:
+        title = await con.fetchval("SELECT title FROM chats WHERE chat_id=$1;", chat_id)
+    if not title:
+        try:
+            chatobj = await bot.get_chat(chat_id)
+            title = getattr(chatobj, "title", None)
+            if title:
+                queue_chat(chatobj)
+        except Exception:
+            title = None
+    # عدم موفقیت فقط کوتاه‌مدت کش می‌شود
+    _chat_titles.set(chat_id, title or "", None if title else 60)
+    return title or fallback
+
 async def mark_chat_active(chat_id: int, active: bool):
-    async with pool.acquire() as con:
+    if not active:
+        forget_buffered_chat(chat_id)
+    async with db("mark_chat_active") as con:
         await con.execute("UPDATE chats SET is_active=$1, last_seen=NOW() WHERE chat_id=$2;", active, chat_id)
 
 async def get_active_group_count() -> int:
-    async with pool.acquire() as con:
+    async with db("get_active_group_count") as con:
         return await con.fetchval("SELECT COUNT(*) FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")
 
-async def get_name_for(user_id: int, fallback: str = "کاربر") -> str:
-    async with pool.acquire() as con:
-        row = await con.fetchrow(
-            "SELECT COALESCE(NULLIF(first_name,''), NULLIF(username,'')) AS n FROM users WHERE user_id=$1;",
-            user_id
-        )
-    if row and row["n"]:
-        return str(row["n"])
+# کش پروفایل: user_id -> (first_name, username)
+PROFILE_TTL = float(os.environ.get("PROFILE_TTL", "900"))
+_profile_cache = TTLCache(int(os.environ.get("PROFILE_CACHE_MAX", "50000")), PROFILE_TTL)
+
+def _remember_profile(u):
+    _profile_cache.set(u.id, (u.first_name or getattr(u, "full_name", None), u.username))
+
+async def _load_profiles(user_ids):
+    missing = [uid for uid in set(user_ids) if uid not in _profile_cache]
+    if not missing:
+        return
+    async with db("_load_profiles") as con:
+        rows = await con.fetch("SELECT user_id, first_name, username FROM users WHERE user_id = ANY($1::bigint[]);", missing)
+    for r in rows:
+        _profile_cache.set(int(r["user_id"]), (r["first_name"], r["username"]))
+    found = {int(r["user_id"]) for r in rows}
+    for uid in missing:
+        if uid not in found:
+            _profile_cache.set(uid, (None, None), 60)
+
+async def _name_from_api(user_id: int, fallback: str) -> str:
     try:
-        return sanitize((await app.bot.get_chat(user_id)).first_name)  # type: ignore
+        ch = await app.bot.get_chat(user_id)  # type: ignore
+        _remember_profile(ch)
+        return sanitize(ch.first_name)
     except Exception:
         return sanitize(fallback)
 
+async def get_names(user_ids, fallback: str = "کاربر") -> dict:
+    await _load_profiles(user_ids)
+    names, unknown = {}, []
+    for uid in set(user_ids):
+        first_name, username = _profile_cache.get(uid, (None, None))
+        if first_name or username:
+            names[uid] = str(first_name or username)
+        else:
+            unknown.append(uid)
+    if unknown:
+        for uid, n in zip(unknown, await asyncio.gather(*(_name_from_api(uid, fallback) for uid in unknown))):
+            names[uid] = n
+    return names
+
+async def get_name_for(user_id: int, fallback: str = "کاربر") -> str:
+    return (await get_names([user_id], fallback))[user_id]
+
 async def get_username_for(user_id: int) -> str:
-    async with pool.acquire() as con:
-        row = await con.fetchrow("SELECT username FROM users WHERE user_id=$1;", user_id)
-    if row and row["username"]:
-        return str(row["username"]).lstrip("@")
+    await _load_profiles([user_id])
+    _, username = _profile_cache.get(user_id, (None, None))
+    if username:
+        return str(username).lstrip("@")
     try:
         ch = await app.bot.get_chat(user_id)  # type: ignore
+        _remember_profile(ch)
         if getattr(ch, "username", None):
             return ch.username.lstrip("@")
     except Exception:
         pass
     return ""
 
+# username → user_id: اول حافظه، بعد جدول users، در آخر Bot API
+USERNAME_TTL = float(os.environ.get("USERNAME_TTL", "3600"))
+USERNAME_TTL_MISS = float(os.environ.get("USERNAME_TTL_MISS", "300"))
+_username_cache = TTLCache(int(os.environ.get("USERNAME_CACHE_MAX", "20000")), USERNAME_TTL)  # 0 یعنی «پیدا نشد»
+
+def _remember_username(user_id: int, username: str | None):
+    if username:
+        _username_cache.set(username.lstrip("@").lower(), user_id)
+
 async def try_resolve_user_id_by_username(context: ContextTypes.DEFAULT_TYPE, username: str):
     if not username:
         return None
+    key = username.lstrip("@").lower()
+    cached = _username_cache.get(key)
+    if cached is not None:
+        return cached or None
+
+    async with db("try_resolve_user_id_by_username") as con:
+        uid = await con.fetchval(
+            "SELECT user_id FROM users WHERE lower(username)=$1 ORDER BY last_seen DESC NULLS LAST LIMIT 1;",
+            key
+        )
+    if uid:
+        _username_cache.set(key, int(uid))
+        return int(uid)
+
     try:
-        ch = await context.bot.get_chat(f"@{username}")
-        return int(getattr(ch, "id", 0)) or None
+        ch = await context.bot.get_chat(f"@{key}")
+        uid = int(getattr(ch, "id", 0)) or None
     except Exception:
+        ch, uid = None, None
+    if not uid:
+        _username_cache.set(key, 0, USERNAME_TTL_MISS)
         return None
+    _username_cache.set(key, uid)
+    if ch.type == ChatType.PRIVATE:
+        await upsert_user(ch)
+    return uid
 
 async def upsert_contact(owner_id: int, peer_id: int | None, peer_username: str | None, peer_name: str | None):
     if not peer_id and not peer_username:
         return
     key = f"@{peer_username.lower()}" if peer_username else f"id:{peer_id}"
-    async with pool.acquire() as con:
+    _touch_recent_contact(owner_id, key, peer_id, peer_username, peer_name)
+    async with db("upsert_contact") as con:
         await con.execute(
             """INSERT INTO whisper_contacts(owner_id, peer_key, peer_id, peer_username, peer_name, last_used)
                VALUES ($1,$2,$3,$4,$5,NOW())
@@ -261,24 +859,302 @@ async def upsert_contact(owner_id: int, peer_id: int | None, peer_username: str
             owner_id, key, peer_id, (peer_username or None), (peer_name or None)
         )
 
-async def get_recent_contacts(owner_id: int, limit: int = 8):
-    async with pool.acquire() as con:
+# ---------- نوشتن تأخیری (write-behind) برای ثبت پیام‌های گروه ----------
+# آپسرت‌های تکراری برای یک کلید در حافظه ادغام و به‌صورت دسته‌ای نوشته می‌شوند.
+WRITE_BEHIND_SEC = float(os.environ.get("WRITE_BEHIND_SEC", "2"))
+WRITE_BEHIND_MAX = int(os.environ.get("WRITE_BEHIND_MAX", "500"))
+
+_wb_users: dict = {}      # user_id -> (username, first_name)
+_wb_chats: dict = {}      # chat_id -> (title, type, is_active, queued_at)
+_wb_contacts: dict = {}   # (owner_id, peer_key) -> (peer_id, peer_username, peer_name)
+_wb_stats: dict = {}      # (day, kind) -> n  شمارنده‌های روزانه
+_wb_pending: dict = {}    # sender_id -> رکورد پندینگ یا None برای حذف
+_wb_wakeup: asyncio.Event | None = None
+
+def _wb_size() -> int:
+    return len(_wb_users) + len(_wb_chats) + len(_wb_contacts) + len(_wb_pending)
+
+def _wb_kick():
+    if _wb_wakeup is not None and _wb_size() >= WRITE_BEHIND_MAX:
+        _wb_wakeup.set()
+
+def queue_user(u):
+    _remember_username(u.id, u.username)
+    _remember_profile(u)
+    _wb_users[u.id] = (u.username, u.first_name or u.full_name)
+    _wb_kick()
+
+def queue_chat(c, active: bool = True):
+    _remember_chat(c)
+    _wb_chats[c.id] = (getattr(c, "title", None), c.type, active, datetime.now(timezone.utc))
+    _wb_kick()
+
+def forget_buffered_chat(chat_id: int):
+    # غیرفعال‌سازی هم‌زمان نوشته می‌شود؛ نسخهٔ بافرشده نباید بعداً روی آن بنشیند
+    _wb_chats.pop(chat_id, None)
+
+def queue_contact(owner_id: int, peer_id: int | None, peer_username: str | None, peer_name: str | None):
+    if not peer_id and not peer_username:
+        return
+    key = (owner_id, f"@{peer_username.lower()}" if peer_username else f"id:{peer_id}")
+    old = _wb_contacts.get(key, (None, None, None))
+    _wb_contacts[key] = (peer_id or old[0], peer_username or old[1], peer_name or old[2])
+    _touch_recent_contact(owner_id, key[1], peer_id, peer_username, peer_name)
+    _wb_kick()
+
+# ---------- پندینگ‌ها در حافظه (write-through به جدول pending) ----------
+# مسیر خواندن اول حافظه است؛ هر تغییر فوراً برای نوشتن ناهمگام صف می‌شود.
+# با چند replica تریگر گروه و متن خصوصی ممکن است به دو نسخهٔ مختلف برسند: نبودن در حافظه با یک SELECT جبران می‌شود
+# و هر flush با NOTIFY روی PENDING_CHANNEL نسخهٔ حافظهٔ بقیه را باطل می‌کند.
+PENDING_CHANNEL = "najnaj_pending"
+_pending: dict = {}   # sender_id -> dict(sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id, reply_to_msg_id)
+
+def _pending_changed(sender_id: int):
+    _wb_pending[sender_id] = _pending.get(sender_id)
+    if _wb_wakeup is not None:
+        _wb_wakeup.set()
+
+async def get_pending(sender_id: int) -> dict | None:
+    row = _pending.get(sender_id)
+    if row is None:
+        if sender_id in _wb_pending and _wb_pending[sender_id] is None:
+            return None  # حذف همین نسخه هنوز نوشته نشده
+        async with db("get_pending") as con:
+            r = await con.fetchrow(
+                """SELECT sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id, reply_to_msg_id
+                   FROM pending WHERE sender_id=$1 AND expires_at > NOW();""",
+                sender_id
+            )
+        if r is None:
+            return None
+        row = _pending.setdefault(sender_id, dict(r))
+    if row["expires_at"] <= datetime.now(timezone.utc):
+        # رکورد جدول را پاکسازی دوره‌ای حذف می‌کند
+        _pending.pop(sender_id, None)
+        return None
+    return row
+
+def set_pending(sender_id: int, group_id: int, receiver_id: int, reply_to_msg_id: int | None):
+    _pending[sender_id] = {
+        "sender_id": sender_id, "group_id": group_id, "receiver_id": receiver_id,
+        "created_at": datetime.now(timezone.utc), "expires_at": expires_in(PENDING_TTL_SEC),
+        "guide_message_id": None, "reply_to_msg_id": reply_to_msg_id,
+    }
+    _pending_changed(sender_id)
+
+def set_pending_guide(sender_id: int, guide_message_id: int):
+    row = _pending.get(sender_id)
+    if row is not None:
+        row["guide_message_id"] = guide_message_id
+        _pending_changed(sender_id)
+
+def drop_pending(sender_id: int):
+    if _pending.pop(sender_id, None) is not None:
+        _pending_changed(sender_id)
+
+def sweep_pending():
+    now = datetime.now(timezone.utc)
+    for k in [k for k, v in _pending.items() if v["expires_at"] <= now]:
+        _pending.pop(k, None)
+
+def _on_pending_notify(con, pid, channel, payload):
+    try:
+        owner, ids = payload.split(":", 1)
+        if owner == INSTANCE_ID:
+            return
+        for sender_id in ids.split(","):
+            _pending.pop(int(sender_id), None)
+    except Exception:
+        pass
+
+async def load_pending():
+    async with db("load_pending") as con:
+        rows = await con.fetch(
+            """SELECT sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id, reply_to_msg_id
+               FROM pending WHERE expires_at > NOW();"""
+        )
+    for r in rows:
+        _pending.setdefault(int(r["sender_id"]), dict(r))
+
+def bump_stat(kind: str, n: int = 1):
+    key = (datetime.now(timezone.utc).date(), kind)
+    _wb_stats[key] = _wb_stats.get(key, 0) + n
+
+async def flush_writes():
+    global _wb_users, _wb_chats, _wb_contacts, _wb_stats, _wb_pending
+    users, chats, contacts, stats, pending = _wb_users, _wb_chats, _wb_contacts, _wb_stats, _wb_pending
+    _wb_users, _wb_chats, _wb_contacts, _wb_stats, _wb_pending = {}, {}, {}, {}, {}
+    if not (users or chats or contacts or stats or pending):
+        return
+    try:
+        async with db("flush_writes") as con, con.transaction():
+            if chats:
+                # پیام گروه یعنی ربات هنوز آنجاست: گروه غیرفعال دوباره فعال می‌شود، مگر غیرفعال‌سازی
+                # (که last_seen را هم جلو می‌برد) بعد از صف شدن همین ورودی نوشته شده باشد؛ EXCLUDED.last_seen زمان صف شدن است
+                await con.execute(
+                    """INSERT INTO chats AS c (chat_id, title, type, is_active, last_seen)
+                       SELECT * FROM UNNEST($1::bigint[], $2::text[], $3::text[], $4::bool[], $5::timestamptz[])
+                       ON CONFLICT (chat_id) DO UPDATE SET
+                         title=EXCLUDED.title, type=EXCLUDED.type, last_seen=NOW(),
+                         is_active = c.is_active OR (EXCLUDED.is_active AND (c.last_seen IS NULL OR c.last_seen < EXCLUDED.last_seen));""",
+                    list(chats), [v[0] for v in chats.values()], [v[1] for v in chats.values()],
+                    [v[2] for v in chats.values()], [v[3] for v in chats.values()]
+                )
+            if users:
+                await con.execute(
+                    """INSERT INTO users (user_id, username, first_name, last_seen)
+                       SELECT i, u, f, NOW() FROM UNNEST($1::bigint[], $2::text[], $3::text[]) AS x(i, u, f)
+                       ON CONFLICT (user_id) DO UPDATE SET
+                         username=EXCLUDED.username, first_name=EXCLUDED.first_name, last_seen=NOW();""",
+                    list(users), [v[0] for v in users.values()], [v[1] for v in users.values()]
+                )
+            if contacts:
+                await con.execute(
+                    """INSERT INTO whisper_contacts(owner_id, peer_key, peer_id, peer_username, peer_name, last_used)
+                       SELECT o, k, p, u, n, NOW() FROM UNNEST($1::bigint[], $2::text[], $3::bigint[], $4::text[], $5::text[]) AS x(o, k, p, u, n)
+                       ON CONFLICT (owner_id, peer_key) DO UPDATE SET
+                         peer_id=COALESCE(EXCLUDED.peer_id, whisper_contacts.peer_id),
+                         peer_username=COALESCE(EXCLUDED.peer_username, whisper_contacts.peer_username),
+                         peer_name=COALESCE(EXCLUDED.peer_name, whisper_contacts.peer_name),
+                         last_used=NOW();""",
+                    [k[0] for k in contacts], [k[1] for k in contacts],
+                    [v[0] for v in contacts.values()], [v[1] for v in contacts.values()], [v[2] for v in contacts.values()]
+                )
+            if stats:
+                await con.execute(
+                    """INSERT INTO stats_daily (day, kind, n)
+                       SELECT d, k, n FROM UNNEST($1::date[], $2::text[], $3::bigint[]) AS x(d, k, n)
+                       ON CONFLICT (day, kind) DO UPDATE SET n = stats_daily.n + EXCLUDED.n;""",
+                    [k[0] for k in stats], [k[1] for k in stats], list(stats.values())
+                )
+            if pending:
+                live = [v for v in pending.values() if v is not None]
+                gone = [k for k, v in pending.items() if v is None]
+                if gone:
+                    await con.execute("DELETE FROM pending WHERE sender_id = ANY($1::bigint[]);", gone)
+                if live:
+                    await con.execute(
+                        """INSERT INTO pending (sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id, reply_to_msg_id)
+                           SELECT * FROM UNNEST($1::bigint[], $2::bigint[], $3::bigint[], $4::timestamptz[], $5::timestamptz[], $6::int[], $7::bigint[])
+                           ON CONFLICT (sender_id) DO UPDATE SET
+                             group_id=EXCLUDED.group_id, receiver_id=EXCLUDED.receiver_id, created_at=EXCLUDED.created_at,
+                             expires_at=EXCLUDED.expires_at, guide_message_id=EXCLUDED.guide_message_id,
+                             reply_to_msg_id=EXCLUDED.reply_to_msg_id;""",
+                        [v["sender_id"] for v in live], [v["group_id"] for v in live], [v["receiver_id"] for v in live],
+                        [v["created_at"] for v in live], [v["expires_at"] for v in live],
+                        [v["guide_message_id"] for v in live], [v["reply_to_msg_id"] for v in live]
+                    )
+                ids = [str(k) for k in pending]
+                for i in range(0, len(ids), 400):  # سقف payload در NOTIFY حدود 8000 بایت است
+                    await con.execute("SELECT pg_notify($1, $2);", PENDING_CHANNEL, f"{INSTANCE_ID}:{','.join(ids[i:i + 400])}")
+    except (Exception, asyncio.CancelledError) as e:
+        # برگرداندن به بافر بدون بازنویسی مقادیر تازه‌تر
+        for k, v in users.items(): _wb_users.setdefault(k, v)
+        for k, v in chats.items(): _wb_chats.setdefault(k, v)
+        for k, v in contacts.items(): _wb_contacts.setdefault(k, v)
+        for k, v in stats.items(): _wb_stats[k] = _wb_stats.get(k, 0) + v
+        for k, v in pending.items(): _wb_pending.setdefault(k, v)
+        if isinstance(e, asyncio.CancelledError):
+            raise
+
+async def _write_behind_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_wb_wakeup.wait(), timeout=WRITE_BEHIND_SEC)
+        except asyncio.TimeoutError:
+            pass
+        _wb_wakeup.clear()
+        await flush_writes()
+        sweep_pending()
+
+def start_write_behind(bot):
+    global _wb_wakeup
+    _wb_wakeup = asyncio.Event()
+    spawn_background("write_behind", _write_behind_loop())
+
+# --- کش مخاطبین اخیر هر کاربر؛ upsert_contact/queue_contact آن را درجا به‌روز می‌کنند ---
+RECENT_CONTACTS_LIMIT = 8
+_recent_contacts = TTLCache(int(os.environ.get("RECENT_CONTACTS_MAX", "20000")),
+                            float(os.environ.get("RECENT_CONTACTS_TTL", "1800")))  # owner_id -> [dict] جدیدترین اول
+
+def _merge_contact(items: list, key: str, peer_id, peer_username, peer_name) -> list:
+    # مثل COALESCE در آپسرت: مقدار خالی جدید، مقدار قبلی را پاک نمی‌کند
+    old = next((c for c in items if c["peer_key"] == key), None) or {}
+    entry = {
+        "peer_key": key,
+        "peer_id": peer_id or old.get("peer_id"),
+        "peer_username": peer_username or old.get("peer_username"),
+        "peer_name": peer_name or old.get("peer_name"),
+    }
+    return ([entry] + [c for c in items if c["peer_key"] != key])[:RECENT_CONTACTS_LIMIT]
+
+def _touch_recent_contact(owner_id: int, key: str, peer_id: int | None, peer_username: str | None, peer_name: str | None):
+    items = _recent_contacts.get(owner_id)
+    if items is not None:  # در غیر این صورت بار بعدی از دیتابیس + بافر خوانده می‌شود
+        _recent_contacts.set(owner_id, _merge_contact(items, key, peer_id, peer_username, peer_name))
+    _inline_memo_invalidate(owner_id)
+
+async def get_recent_contacts(owner_id: int, limit: int = RECENT_CONTACTS_LIMIT):
+    items = _recent_contacts.get(owner_id)
+    if items is not None:
+        return items[:limit]
+    async with db("get_recent_contacts") as con:
         rows = await con.fetch(
-            "SELECT peer_id, peer_username, peer_name FROM whisper_contacts WHERE owner_id=$1 ORDER BY last_used DESC LIMIT $2;",
-            owner_id, limit
+            "SELECT peer_key, peer_id, peer_username, peer_name FROM whisper_contacts WHERE owner_id=$1 ORDER BY last_used DESC LIMIT $2;",
+            owner_id, RECENT_CONTACTS_LIMIT
         )
-    return rows
+    items = [dict(r) for r in rows]
+    # مخاطبینی که هنوز در بافر write-behind هستند از ردیف‌های دیتابیس تازه‌ترند
+    buffered = [(k[1], v) for k, v in _wb_contacts.items() if k[0] == owner_id]
+    for key, (peer_id, peer_username, peer_name) in buffered:
+        items = _merge_contact(items, key, peer_id, peer_username, peer_name)
+    _recent_contacts.set(owner_id, items)
+    return items[:limit]
 
 # ---------- عضویت ----------
-async def is_member_required_channel(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+MEMBER_TTL_OK = float(os.environ.get("MEMBER_TTL_OK", "600"))
+MEMBER_TTL_FAIL = float(os.environ.get("MEMBER_TTL_FAIL", "20"))
+_member_cache = TTLCache(int(os.environ.get("MEMBER_CACHE_MAX", "50000")), MEMBER_TTL_OK)
+_member_inflight: dict = {}  # user_id -> Task
+_member_gen: dict = {}       # user_id -> شمارهٔ جدیدترین بررسی؛ نتیجهٔ بررسی‌های قدیمی‌تر کش نمی‌شود
+_member_seq = 0
+
+async def _check_membership(bot, user_id: int) -> bool | None:
+    """True/False قطعی؛ None یعنی خطای گذرا (RetryAfter، شبکه، ...) که نباید کش شود."""
+    async def one(ch: str) -> bool:
+        m = await bot.get_chat_member(f"@{ch}", user_id)
+        return getattr(m, "status", "") in ("member", "administrator", "creator")
     try:
-        for ch in MANDATORY_CHANNELS:
-            m = await context.bot.get_chat_member(f"@{ch}", user_id)
-            if getattr(m, "status", "") not in ("member", "administrator", "creator"):
-                return False
-        return True
+        return all(await asyncio.gather(*(one(ch) for ch in MANDATORY_CHANNELS)))
+    except BadRequest as e:
+        return False if "user not found" in str(e).lower() else None
     except Exception:
-        return False
+        return None
+
+async def is_member_required_channel(context: ContextTypes.DEFAULT_TYPE, user_id: int, force: bool = False) -> bool:
+    global _member_seq
+    if not force:
+        cached = _member_cache.get(user_id)
+        if cached is not None:
+            return cached
+    task = _member_inflight.get(user_id)
+    if task is None or force:
+        _member_seq += 1
+        _member_gen[user_id] = gen = _member_seq
+        task = asyncio.ensure_future(_check_membership(context.bot, user_id))
+        _member_inflight[user_id] = task
+        def _done(t, uid=user_id, gen=gen):
+            if _member_inflight.get(uid) is t:
+                del _member_inflight[uid]
+            if _member_gen.get(uid) != gen:
+                return  # بررسی تازه‌تری (مثلاً «عضو شدم») شروع شده است
+            del _member_gen[uid]
+            if not t.cancelled() and t.result() is not None:
+                ok = t.result()
+                _member_cache.set(uid, ok, MEMBER_TTL_OK if ok else MEMBER_TTL_FAIL)
+        task.add_done_callback(_done)
+    # خطا مثل قبل «عضو نیست» حساب می‌شود ولی کش نمی‌شود
+    return bool(await asyncio.shield(task))
 
 def _channels_text():
     return "، ".join([f"@{ch}" for ch in MANDATORY_CHANNELS])
@@ -319,25 +1195,17 @@ INTRO_TEXT = (
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
-    await upsert_user(update.effective_user)
+    await upsert_user(update.effective_user, unblock=True)
 
     ok = await is_member_required_channel(context, update.effective_user.id)
     if ok:
         await update.message.reply_text(INTRO_TEXT, reply_markup=start_keyboard_post())
         # اگر پندینگ فعال دارد، پیام انتظار بفرست
-        async with pool.acquire() as con:
-            row = await con.fetchrow(
-                "SELECT group_id, receiver_id FROM pending WHERE sender_id=$1 AND expires_at>NOW();",
-                update.effective_user.id
-            )
+        row = await get_pending(update.effective_user.id)
         if row:
             group_id = int(row["group_id"])
             receiver_id = int(row["receiver_id"])
-            try:
-                chatobj = await context.bot.get_chat(group_id)
-                gtitle = group_link_title(getattr(chatobj, "title", "گروه"))
-            except Exception:
-                gtitle = "گروه"
+            gtitle = group_link_title(await get_chat_title(context.bot, group_id))
             receiver_name = await get_name_for(receiver_id, "گیرنده")
             await update.message.reply_text(
                 f"⌛️ در انتظارِ متنِ نجوای شما…\n"
@@ -352,7 +1220,7 @@ async def on_checksub(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE:
         return
     user = update.effective_user
-    ok = await is_member_required_channel(context, user.id)
+    ok = await is_member_required_channel(context, user.id, force=True)
     if ok:
         await update.callback_query.answer("عضویت تایید شد ✅", show_alert=False)
         await update.callback_query.message.reply_text(INTRO_TEXT, reply_markup=start_keyboard_post())
@@ -378,7 +1246,7 @@ async def group_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(rows),
         disable_web_page_preview=True
     )
-    schedule_delete(context, chat.id, sent.message_id, GUIDE_DELETE_AFTER_SEC)
+    await schedule_delete(chat.id, sent.message_id, GUIDE_DELETE_AFTER_SEC)
 
 # ---------- Inline Mode ----------
 BOT_USERNAME: str = ""
@@ -387,7 +1255,209 @@ INLINE_HELP = "فرمت: «@{bot} متن نجوا @username»\nمثال: @{bot}
 def _preview(s: str, n: int = 50) -> str:
     return s if len(s) <= n else (s[:n] + "…")
 
+# اجزای ثابت هر نتیجه (عنوان، تصویر، محتوای پیام) یک بار ساخته می‌شوند؛ اشیای تلگرام تغییرناپذیرند
+@functools.lru_cache(maxsize=4096)
+def _result_skeleton(title: str, label: str, thumb_seed: str):
+    return title, avatar_url(thumb_seed), InputTextMessageContent(f"🔒 نجوا برای {label}")
+
+def _show_markup(token: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔒 نمایش پیام", callback_data=f"iws:{token}")]])
+
+def _whisper_result(token: str, skeleton, text: str) -> InlineQueryResultArticle:
+    title, thumb, content = skeleton
+    return InlineQueryResultArticle(
+        id=token,
+        title=title,
+        description=_preview(text) if text else "بدون متن",
+        input_message_content=content,
+        reply_markup=_show_markup(token),
+        thumbnail_url=thumb,
+        thumbnail_width=64,
+        thumbnail_height=64,
+    )
+
+@functools.lru_cache(maxsize=1)
+def _join_info_result() -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id="join_info",
+        title="ℹ️ عضویت فقط برای ریپلای لازم است (اینلاین آزاد است)",
+        description=_channels_text(),
+        input_message_content=InputTextMessageContent(
+            f"راهنما: نجوای اینلاین آزاد است؛ برای ریپلای عضو شوید.\nکانال‌ها: {_channels_text()}"
+        )
+    )
+
+@functools.lru_cache(maxsize=4)
+def _help_result(bot_username: str | None) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id="help",
+        title="راهنما",
+        description="متن بنویسید و هرجا @username را اضافه کنید (یا خالی بگذارید تا مخاطبین اخیر بیاید).",
+        input_message_content=InputTextMessageContent(INLINE_HELP(bot=bot_username)),
+        thumbnail_url=avatar_url("help"),
+        thumbnail_width=64,
+        thumbnail_height=64,
+    )
+
+# پیش‌نویس‌های اینلاین اول در حافظه‌اند؛ تنها توکنِ انتخاب‌شده در iwhispers ثبت می‌شود.
+# ChosenInlineResult یا کلیک iws: ممکن است به replica دیگری برسد، پس هر پاسخ اینلاین پیش‌نویس‌هایش را
+# با یک درج دسته‌ای در جدول inline_drafts هم می‌گذارد (INLINE_DRAFTS_SHARED=0 فقط برای اجرای تک‌نسخه‌ای).
+# برای ثبت به‌موقع در BotFather با /setinlinefeedback مقدار 100% را بدهید؛ پیش‌نویس پس از INLINE_DRAFT_TTL باطل است.
+INLINE_DEBOUNCE_SEC = float(os.environ.get("INLINE_DEBOUNCE_SEC", "0.3"))
+INLINE_DRAFT_TTL = float(os.environ.get("INLINE_DRAFT_TTL", "3600"))
+INLINE_DRAFTS_SHARED = os.environ.get("INLINE_DRAFTS_SHARED", "1") == "1"
+_inline_drafts = TTLCache(int(os.environ.get("INLINE_DRAFTS_MAX", "20000")), INLINE_DRAFT_TTL)
+_inline_tasks: dict = {}  # user_id -> Task آخرین کوئری
+
+def _new_draft(sender_id: int, receiver_id: int | None, receiver_username: str | None, text: str) -> str:
+    token = token_urlsafe(12)
+    _inline_drafts.set(token, {
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "receiver_username": receiver_username,
+        "text": text,
+    })
+    return token
+
+async def share_inline_drafts(tokens: list):
+    if not INLINE_DRAFTS_SHARED or not tokens:
+        return
+    drafts = [(t, _inline_drafts.get(t)) for t in tokens]
+    drafts = [(t, d) for t, d in drafts if d is not None]
+    async with db("share_inline_drafts") as con:
+        await con.execute(
+            """INSERT INTO inline_drafts (token, sender_id, receiver_id, receiver_username, text, expires_at)
+               SELECT t, s, r, u, x, NOW() + make_interval(secs => $6)
+               FROM UNNEST($1::text[], $2::bigint[], $3::bigint[], $4::text[], $5::text[]) AS d(t, s, r, u, x)
+               ON CONFLICT (token) DO NOTHING;""",
+            [t for t, _ in drafts], [d["sender_id"] for _, d in drafts], [d["receiver_id"] for _, d in drafts],
+            [d["receiver_username"] for _, d in drafts], [d["text"] for _, d in drafts], INLINE_DRAFT_TTL
+        )
+
+async def persist_inline_draft(con, token: str):
+    """پیش‌نویس را روی اتصال داده‌شده در iwhispers ثبت می‌کند؛ هندلرها همهٔ کارهای یک کلیک را روی یک اتصال انجام می‌دهند."""
+    # پیش‌نویس تا commit شدن درج در حافظه می‌ماند تا کلیک هم‌زمان یا خطای درج آن را گم نکند
+    d = _inline_drafts.get(token)
+    if d is None:
+        if not INLINE_DRAFTS_SHARED:
+            return None
+        # پیش‌نویسِ replica دیگر
+        row = await con.fetchrow(
+            """INSERT INTO iwhispers (token, sender_id, receiver_id, receiver_username, text, expires_at, reported)
+               SELECT token, sender_id, receiver_id, receiver_username, text, $2, FALSE
+               FROM inline_drafts WHERE token=$1 AND expires_at > NOW()
+               ON CONFLICT (token) DO NOTHING
+               RETURNING sender_id, receiver_id, receiver_username, text;""",
+            token, expires_in(INLINE_UNREPORTED_TTL_SEC)
+        )
+        if row is None:
+            return None
+        bump_stat("sent_inline")
+        return dict(row)
+    inserted = await con.fetchval(
+        "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported) VALUES ($1,$2,$3,$4,$5,$6,FALSE) ON CONFLICT (token) DO NOTHING RETURNING TRUE;",
+        token, d["sender_id"], d["receiver_id"], d["receiver_username"], d["text"], expires_in(INLINE_UNREPORTED_TTL_SEC)
+    )
+    _inline_drafts.pop(token)
+    if inserted:
+        bump_stat("sent_inline")
+    return d
+
+# --- کش پاسخ‌های اینلاین ---
+# برای (کاربر، کوئری نرمال‌شده) همان نتایج و همان توکن‌ها برگردانده می‌شود تا کش شخصی تلگرام (cache_time) هم قابل استفاده باشد.
+# چون تلگرام ممکن است یک توکن را دوباره تحویل بدهد، هر پیام اینلاین صاحب توکن خودش می‌شود (claim_inline_token).
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "30"))
+INLINE_MEMO_TTL = float(os.environ.get("INLINE_MEMO_TTL", "120"))
+INLINE_MEMO_PER_USER = int(os.environ.get("INLINE_MEMO_PER_USER", "5"))
+_inline_memo = TTLCache(int(os.environ.get("INLINE_MEMO_MAX", "20000")), INLINE_MEMO_TTL)  # user_id -> OrderedDict(key -> (exp, results, tokens))
+_inline_clones = TTLCache(int(os.environ.get("INLINE_CLONES_MAX", "5000")), float(os.environ.get("INLINE_CLONE_TTL", "3600")))  # inline_message_id -> توکن تازه
+
+def _inline_memo_key(q: str, is_member: bool):
+    return " ".join(q.split()), is_member
+
+def _inline_memo_get(user_id: int, key):
+    memo = _inline_memo.get(user_id)
+    item = memo and memo.get(key)
+    if not item:
+        return None
+    exp, results, tokens = item
+    # اگر پیش‌نویسی در این فاصله ثبت یا بیرون انداخته شده باشد، نتایج دوباره ساخته می‌شوند
+    if exp < time.monotonic() or not all(t in _inline_drafts for t in tokens):
+        memo.pop(key, None)
+        return None
+    memo.move_to_end(key)
+    return results
+
+def _inline_memo_put(user_id: int, key, results, tokens):
+    memo = _inline_memo.get(user_id)
+    if memo is None:
+        memo = OrderedDict()
+        _inline_memo.set(user_id, memo)
+    memo[key] = (time.monotonic() + INLINE_MEMO_TTL, results, tokens)
+    memo.move_to_end(key)
+    while len(memo) > INLINE_MEMO_PER_USER:
+        memo.popitem(last=False)
+
+def _inline_memo_invalidate(user_id: int):
+    _inline_memo.pop(user_id)
+
+async def claim_inline_token(con, token: str, inline_message_id: str | None) -> tuple:
+    """توکن را به پیام اینلاین گره می‌زند و (توکن نهایی، کپی‌شده؟) برمی‌گرداند.
+
+    اگر توکن مال پیام دیگری باشد کپی با توکن تازه ساخته می‌شود؛ دکمهٔ پیام را فراخواننده پس از
+    آزاد کردن اتصال با set_show_markup عوض می‌کند.
+    """
+    if not inline_message_id:
+        return token, False
+    cloned = _inline_clones.get(inline_message_id)
+    if cloned:
+        return cloned, False
+    owned = await con.fetchval(
+        """UPDATE iwhispers SET inline_message_id=$2
+           WHERE token=$1 AND (inline_message_id IS NULL OR inline_message_id=$2) RETURNING TRUE;""",
+        token, inline_message_id
+    )
+    if owned:
+        return token, False
+    new_token = token_urlsafe(12)
+    # اگر کلیک و ChosenInlineResult هم‌زمان برسند، فقط یکی کپی می‌سازد و فقط همان شمرده می‌شود
+    copied = await con.fetchval(
+        """INSERT INTO iwhispers (token, sender_id, receiver_id, receiver_username, text, expires_at, reported, inline_message_id)
+           SELECT $2, sender_id, receiver_id, receiver_username, text, $3, FALSE, $4 FROM iwhispers
+           WHERE token=$1 AND NOT EXISTS (SELECT 1 FROM iwhispers WHERE inline_message_id=$4)
+           RETURNING TRUE;""",
+        token, new_token, expires_in(INLINE_UNREPORTED_TTL_SEC), inline_message_id
+    )
+    if not copied:
+        existing = await con.fetchval("SELECT token FROM iwhispers WHERE inline_message_id=$1 LIMIT 1;", inline_message_id)
+        if existing:
+            _inline_clones.set(inline_message_id, existing)
+        return existing, False
+    _inline_clones.set(inline_message_id, new_token)
+    bump_stat("sent_inline")
+    return new_token, True
+
+async def set_show_markup(bot, inline_message_id: str, token: str):
+    try:
+        await bot.edit_message_reply_markup(inline_message_id=inline_message_id, reply_markup=_show_markup(token))
+    except Exception:
+        pass
+
 async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # هر کوئری جدید، کوئری قبلیِ همان کاربر را لغو می‌کند
+    uid = update.inline_query.from_user.id
+    prev = _inline_tasks.get(uid)
+    if prev is not None and not prev.done():
+        prev.cancel()
+    task = context.application.create_task(_answer_inline_query(update, context), update=update)
+    _inline_tasks[uid] = task
+    def _done(t, uid=uid):
+        if _inline_tasks.get(uid) is t:
+            del _inline_tasks[uid]
+    task.add_done_callback(_done)
+
+async def _answer_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.sleep(INLINE_DEBOUNCE_SEC)
     iq = update.inline_query
     q = (iq.query or "").strip()
     user = iq.from_user
@@ -399,16 +1469,16 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         is_member = True
     if not is_member:
-        join_info = InlineQueryResultArticle(
-            id="join_info",
-            title="ℹ️ عضویت فقط برای ریپلای لازم است (اینلاین آزاد است)",
-            description=_channels_text(),
-            input_message_content=InputTextMessageContent(
-                f"راهنما: نجوای اینلاین آزاد است؛ برای ریپلای عضو شوید.\nکانال‌ها: {_channels_text()}"
-            )
-        )
+        join_info = _join_info_result()
+
+    memo_key = _inline_memo_key(q, is_member)
+    results = _inline_memo_get(user.id, memo_key)
+    if results is not None:
+        await iq.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
 
     results = []
+    tokens = []
 
     # یوزرنیم 3+ کاراکتری، آخرین @username را معیار قرار بده
     uname_match = None
@@ -423,31 +1493,13 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if rid:
             rname = await get_name_for(rid, "گیرنده")
-            title = rname
-            thumb = avatar_url(rname)
+            skeleton = _result_skeleton(rname, rname, rname)
         else:
-            title = f"@{uname}"
-            thumb = avatar_url(uname)
+            skeleton = _result_skeleton(f"@{uname}", f"@{uname}", uname)
 
-        token = token_urlsafe(12)
-        async with pool.acquire() as con:
-            await con.execute(
-                "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported) VALUES ($1,$2,$3,$4,$5,$6,FALSE);",
-                token, user.id, rid, uname, text, FAR_FUTURE
-            )
-
-        results.append(
-            InlineQueryResultArticle(
-                id=token,
-                title=title,
-                description=_preview(text) if text else "بدون متن",
-                input_message_content=InputTextMessageContent(f"🔒 نجوا برای {title if rid else '@'+uname}"),
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔒 نمایش پیام", callback_data=f"iws:{token}")]]),
-                thumbnail_url=thumb,
-                thumbnail_width=64,
-                thumbnail_height=64,
-            )
-        )
+        token = _new_draft(user.id, rid, uname, text)
+        tokens.append(token)
+        results.append(_whisper_result(token, skeleton, text))
     else:
         # بدون username → از مخاطبین اخیر پیشنهاد بده
         recents = await get_recent_contacts(user.id, limit=8)
@@ -457,69 +1509,56 @@ async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             run = (r["peer_username"] or "").lower() if r["peer_username"] else None
             pname = r["peer_name"] or (run and f"@{run}") or (rid and f"id:{rid}") or "کاربر"
 
-            token = token_urlsafe(12)
-            async with pool.acquire() as con:
-                await con.execute(
-                    "INSERT INTO iwhispers(token, sender_id, receiver_id, receiver_username, text, expires_at, reported) VALUES ($1,$2,$3,$4,$5,$6,FALSE);",
-                    token, user.id, rid, run, base_text, FAR_FUTURE
-                )
-
-            results.append(
-                InlineQueryResultArticle(
-                    id=token,
-                    title=pname,
-                    description=_preview(base_text) if base_text else "بدون متن",
-                    input_message_content=InputTextMessageContent(f"🔒 نجوا برای {pname}"),
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔒 نمایش پیام", callback_data=f"iws:{token}")]]),
-                    thumbnail_url=avatar_url(pname),
-                    thumbnail_width=64,
-                    thumbnail_height=64,
-                )
-            )
+            token = _new_draft(user.id, rid, run, base_text)
+            tokens.append(token)
+            results.append(_whisper_result(token, _result_skeleton(pname, pname, pname), base_text))
 
     if not results:
-        help_result = InlineQueryResultArticle(
-            id="help",
-            title="راهنما",
-            description="متن بنویسید و هرجا @username را اضافه کنید (یا خالی بگذارید تا مخاطبین اخیر بیاید).",
-            input_message_content=InputTextMessageContent(INLINE_HELP(BOT_USERNAME)),
-            thumbnail_url=avatar_url("help"),
-            thumbnail_width=64,
-            thumbnail_height=64,
-        )
-        results.append(help_result)
+        results.append(_help_result(BOT_USERNAME))
 
     if join_info:
         results.insert(0, join_info)
 
-    await iq.answer(results, cache_time=0, is_personal=True)
+    # پیش از پاسخ، تا انتخاب یا کلیک روی هر replica پیش‌نویس را پیدا کند
+    try:
+        await share_inline_drafts(tokens)
+    except Exception:
+        pass  # همین replica هنوز از حافظه جواب می‌دهد
+    _inline_memo_put(user.id, memo_key, results, tokens)
+    await iq.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
 
 # گزارش فوری «لحظه ارسال اینلاین»
 async def on_chosen_inline_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cir = update.chosen_inline_result
+    _inline_memo_invalidate(cir.from_user.id)
     token = cir.result_id
-    async with pool.acquire() as con:
-        row = await con.fetchrow(
-            "SELECT sender_id, receiver_id, receiver_username, text FROM iwhispers WHERE token=$1;",
-            token
-        )
+    async with db("on_chosen_inline_result") as con:
+        row = await persist_inline_draft(con, token)
+        claimed, cloned = await claim_inline_token(con, token, cir.inline_message_id)
+        if claimed is not None and claimed != token:
+            token, row = claimed, None
+        if not row:
+            row = await con.fetchrow(
+                "SELECT sender_id, receiver_id, receiver_username, text FROM iwhispers WHERE token=$1;",
+                token
+            )
+    if cloned:
+        await set_show_markup(context.bot, cir.inline_message_id, token)
     if not row:
         return
     sender_id = int(row["sender_id"])
     receiver_id = row["receiver_id"] and int(row["receiver_id"])
     receiver_username = row["receiver_username"]
 
-    s_label = mention_html(sender_id, await get_name_for(sender_id, "کاربر"))
+    names = await get_names([sender_id] + ([receiver_id] if receiver_id else []), "کاربر")
+    s_label = mention_html(sender_id, names[sender_id])
     if receiver_id:
-        r_label = mention_html(receiver_id, await get_name_for(receiver_id, "کاربر"))
+        r_label = mention_html(receiver_id, names[receiver_id])
     else:
         r_label = f"@{receiver_username}" if receiver_username else "گیرنده"
 
     msg = f"📝 نجوای اینلاین: {s_label} ➜ {r_label} + {row['text']}"
-    try:
-        await context.bot.send_message(ADMIN_ID, msg, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    except Exception:
-        pass
+    enqueue_report(ADMIN_ID, msg)
 
 async def on_inline_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cq = update.callback_query
@@ -530,26 +1569,41 @@ async def on_inline_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         return
 
-    async with pool.acquire() as con:
-        row = await con.fetchrow(
-            "SELECT token, sender_id, receiver_id, receiver_username, text, reported FROM iwhispers WHERE token=$1;",
-            token
+    # ثبت پیش‌نویس (اگر ChosenInlineResult نرسیده بود)، گره زدن توکن به پیام، خواندن و برداشتن گزارش همه روی یک اتصال
+    msg = cq.message  # دکمهٔ iws: روی پیام اینلاین است و معمولاً cq.message ندارد
+    claimed = False
+    async with db("on_inline_show") as con:
+        await persist_inline_draft(con, token)
+        token, cloned = await claim_inline_token(con, token, cq.inline_message_id)
+        # خواندن همراه با تمدید انقضا: ماندگاری بر اساس آخرین دسترسی است نه زمان ساخت
+        row = token and await con.fetchrow(
+            """UPDATE iwhispers SET expires_at = GREATEST(expires_at, CASE WHEN reported THEN $2 ELSE $3 END)
+               WHERE token=$1
+               RETURNING token, sender_id, receiver_id, receiver_username, text, reported;""",
+            token, expires_in(INLINE_REPORTED_TTL_SEC), expires_in(INLINE_UNREPORTED_TTL_SEC)
         )
+        if row:
+            sender_id = int(row["sender_id"])
+            receiver_id = row["receiver_id"] and int(row["receiver_id"])
+            recv_un = (row["receiver_username"] or "").lower() or None
+            allowed = (user.id == sender_id) or (receiver_id and user.id == receiver_id) or ((user.username or "").lower() == (recv_un or "")) or (user.id == ADMIN_ID)
+            if allowed and not row["reported"]:
+                # فقط اولین کلیک روی همین پیام اینلاین گزارش را «برمی‌دارد» (توکن با claim_inline_token مال این پیام است)
+                claimed = await con.fetchval(
+                    """UPDATE iwhispers SET reported=TRUE, expires_at=$2
+                       WHERE token=$1 AND reported=FALSE AND ($3::text IS NULL OR inline_message_id=$3) RETURNING TRUE;""",
+                    token, expires_in(INLINE_REPORTED_TTL_SEC), cq.inline_message_id
+                )
+    if cloned:
+        await set_show_markup(context.bot, cq.inline_message_id, token)
     if not row:
         await cq.answer("این نجوا نامعتبر است.", show_alert=True)
         return
-
-    sender_id = int(row["sender_id"])
-    receiver_id = row["receiver_id"] and int(row["receiver_id"])
-    recv_un = (row["receiver_username"] or "").lower() or None
-    text = row["text"]
-    already_reported = bool(row["reported"])
-
-    allowed = (user.id == sender_id) or (receiver_id and user.id == receiver_id) or ((user.username or "").lower() == (recv_un or "")) or (user.id == ADMIN_ID)
     if not allowed:
         await cq.answer("فضولی نکن سرت تو لاک خودت باشه بار بعد فحش میدما", show_alert=True)
         return
 
+    text = row["text"]
     alert_text = text if len(text) <= ALERT_SNIPPET else (text[:ALERT_SNIPPET] + " …")
     await cq.answer(alert_text, show_alert=True)
     if len(text) > ALERT_SNIPPET:
@@ -558,78 +1612,79 @@ async def on_inline_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
-    if not already_reported:
-        group_id = cq.message.chat.id
-        group_title = group_link_title(getattr(cq.message.chat, "title", "گروه"))
+    if not claimed:
+        return
+    bump_stat("read_inline")
+    group_id = msg.chat.id if msg is not None else None
+    group_title = group_link_title(getattr(msg.chat, "title", "گروه")) if msg is not None else "پیام اینلاین"
 
-        rid = receiver_id
-        run = recv_un
-        if not rid and (user.username or "").lower() == (run or ""):
-            rid = user.id
-        if not rid and run:
-            rid = await try_resolve_user_id_by_username(context, run)
+    rid = receiver_id
+    run = recv_un
+    if not rid and (user.username or "").lower() == (run or ""):
+        rid = user.id
+    if not rid and run:
+        rid = await try_resolve_user_id_by_username(context, run)
 
-        sender_name = await get_name_for(sender_id, "فرستنده")
+    try:
+        names = await get_names([sender_id] + ([int(rid)] if rid else []), "کاربر")
+        sender_name = names[sender_id]
         if rid:
-            receiver_name = await get_name_for(int(rid), "گیرنده")
+            receiver_name = names[int(rid)]
             run_final = run or (await get_username_for(int(rid))) or None
         else:
             receiver_name = (run or "گیرنده")
             run_final = run
 
-        try:
-            async with pool.acquire() as con:
-                if rid:
-                    exists = await con.fetchval(
-                        "SELECT 1 FROM whispers WHERE group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND text=$4 AND message_id=$5 LIMIT 1;",
-                        group_id, sender_id, int(rid), text, cq.message.message_id
-                    )
-                    if not exists:
-                        await con.execute(
-                            """INSERT INTO whispers (group_id, sender_id, receiver_id, text, status, message_id)
-                               VALUES ($1,$2,$3,$4,'sent',$5);""",
-                            group_id, sender_id, int(rid), text, cq.message.message_id
-                        )
-                await con.execute("UPDATE iwhispers SET reported=TRUE WHERE token=$1;", token)
-
-            await upsert_contact(sender_id, int(rid) if rid else None, run_final, receiver_name if rid else (run_final or "کاربر"))
-
-            await secret_report(
-                context,
-                group_id=group_id,
-                sender_id=sender_id,
-                receiver_id=rid,
-                text=text,
-                group_title=group_title,
-                sender_name=sender_name,
-                receiver_name=receiver_name,
-                origin="inline",
-                receiver_username_fallback=run_final
-            )
-        except Exception:
-            pass
+        if rid and msg is not None:
+            # پیام معمولی (نه اینلاین): درج تکراری با NOT EXISTS روی ایندکس پوششی رد می‌شود
+            async with db("on_inline_show") as con:
+                await write_whisper(
+                    con, "execute",
+                    """INSERT INTO whispers (group_id, sender_id, receiver_id, text, status, message_id)
+                       SELECT $1,$2,$3,$4,'sent',$5
+                       WHERE NOT EXISTS (SELECT 1 FROM whispers WHERE group_id=$1 AND message_id=$5);""",
+                    group_id, sender_id, int(rid), text, msg.message_id
+                )
+
+        queue_contact(sender_id, int(rid) if rid else None, run_final, receiver_name if rid else (run_final or "کاربر"))
+
+        secret_report(
+            group_id=group_id,
+            sender_id=sender_id,
+            receiver_id=rid,
+            text=text,
+            group_title=group_title,
+            sender_name=sender_name,
+            receiver_name=receiver_name,
+            origin="inline",
+            receiver_username_fallback=run_final
+        )
+    except Exception:
+        pass
 
 # ---------- تشخیص تریگر در گروه (ریپلای) ----------
-async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = update.effective_message
-    chat = update.effective_chat
-    user = update.effective_user
+class WordFilter(filters.MessageFilter):
+    """فیلتر هم‌زمان (بدون await) برای متن‌هایی که دقیقاً یکی از کلمات داده‌شده‌اند؛ بقیهٔ پیام‌ها به هندلر نمی‌رسند."""
+    __slots__ = ("words",)
 
-    if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP):
-        return
+    def __init__(self, words, name: str | None = None):
+        super().__init__(name=name)
+        self.words = frozenset(words)
 
-    await upsert_chat(chat, active=True)
-    if user:
-        await upsert_user(user)
+    def filter(self, message) -> bool:
+        text = message.text
+        return bool(text) and text.strip() in self.words
 
-    text = (msg.text or msg.caption or "").strip()
+TRIGGER_FILTER = WordFilter(TRIGGERS, name="TRIGGER_FILTER")
+HELP_FILTER = WordFilter(HELP_WORDS, name="HELP_FILTER")
 
-    # راهنما داخل گروه
-    if text in ("راهنما", "help", "Help"):
-        await group_help(update, context)
-        return
+async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.effective_message
+    chat = update.effective_chat
+    user = update.effective_user
 
-    if text not in TRIGGERS:
+    # فقط پیام‌هایی که TRIGGER_FILTER پذیرفته به اینجا می‌رسند؛ ثبت گروه/کاربر/مخاطب با any_group_message (گروه 2) است
+    if chat.type not in (ChatType.GROUP, ChatType.SUPERGROUP) or user is None:
         return
 
     if msg.reply_to_message is None:
@@ -637,28 +1692,15 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ".روی پیام کاربر مورد نظر دستور نجوا/درگوشی/سکرت را ریپلای کنید\n\n"
             " @RHINOSOUL_TM صفر تا صد هر سرویس "
         )
-        schedule_delete(context, chat.id, warn.message_id, 20)
+        await schedule_delete(chat.id, warn.message_id, 20)
         return
 
     target = msg.reply_to_message.from_user
     if target is None or target.is_bot:
         return
 
-    await upsert_user(target)
-
-    # پندینگ بدون انقضا + ذخیره‌ی آیدی پیام هدف
-    async with pool.acquire() as con:
-        await con.execute(
-            """INSERT INTO pending (sender_id, group_id, receiver_id, created_at, expires_at, guide_message_id, reply_to_msg_id)
-               VALUES ($1,$2,$3,NOW(),$4,NULL,$5)
-               ON CONFLICT (sender_id) DO UPDATE SET
-                 group_id=EXCLUDED.group_id, receiver_id=EXCLUDED.receiver_id,
-                 created_at=NOW(), expires_at=$4, reply_to_msg_id=$5;""",
-            user.id, chat.id, target.id, FAR_FUTURE, msg.reply_to_message.message_id
-        )
-
-    # مخاطب اخیر
-    await upsert_contact(user.id, target.id, target.username or None, target.first_name or None)
+    # پندینگ با انقضای PENDING_TTL_SEC + ذخیره‌ی آیدی پیام هدف
+    set_pending(user.id, chat.id, target.id, msg.reply_to_message.message_id)
 
     member_ok = await is_member_required_channel(context, user.id)
     if not member_ok:
@@ -675,7 +1717,7 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_to_message_id=msg.reply_to_message.message_id,
             reply_markup=InlineKeyboardMarkup(rows)
         )
-        schedule_delete(context, chat.id, m.message_id, GUIDE_DELETE_AFTER_SEC)
+        await schedule_delete(chat.id, m.message_id, GUIDE_DELETE_AFTER_SEC)
         if not KEEP_TRIGGER_MESSAGE:
             await safe_delete(context.bot, chat.id, msg.message_id)
         return
@@ -686,10 +1728,9 @@ async def group_trigger(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_to_message_id=msg.reply_to_message.message_id,
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("✍️ارسال متن در پیوی ربات", url=f"https://t.me/{BOT_USERNAME or 'DareGushi1_BOT'}?start=go")]])
     )
-    async with pool.acquire() as con:
-        await con.execute("UPDATE pending SET guide_message_id=$1 WHERE sender_id=$2;", guide.message_id, user.id)
+    set_pending_guide(user.id, guide.message_id)
 
-    schedule_delete(context, chat.id, guide.message_id, GUIDE_DELETE_AFTER_SEC)
+    await schedule_delete(chat.id, guide.message_id, GUIDE_DELETE_AFTER_SEC)
     if not KEEP_TRIGGER_MESSAGE:
         await safe_delete(context.bot, chat.id, msg.message_id)
 
@@ -717,7 +1758,7 @@ async def on_checksub_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await cq.answer("این دکمه مخصوص فرستنده است.", show_alert=True)
         return
 
-    if await is_member_required_channel(context, cq.from_user.id):
+    if await is_member_required_channel(context, cq.from_user.id, force=True):
         await cq.answer("عضویت تایید شد ✅", show_alert=False)
         await cq.edit_message_text(
             "✅ عضویت تایید شد. به پیوی ربات برو و متن نجوا را بفرست (فقط متن).",
@@ -726,7 +1767,7 @@ async def on_checksub_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         )
         try:
-            gtitle = group_link_title((await context.bot.get_chat(gid)).title)
+            gtitle = group_link_title(await get_chat_title(context.bot, gid))
             await context.bot.send_message(
                 cq.from_user.id,
                 f"⌛️ در انتظارِ متنِ نجوای شما…\n"
@@ -745,11 +1786,11 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     user = update.effective_user
-    await upsert_user(user)
+    queue_user(user)
     txt = (update.message.text or "").strip()
 
     # راهنما
-    if txt in ("راهنما", "help", "Help"):
+    if txt in HELP_WORDS:
         await update.message.reply_text(
             "راهنمای استفاده:\n"
             "• روش ریپلای: روی پیام شخصِ هدف در گروه «Reply» کنید و کلمه «نجوا/درگوشی/سکرت» را بفرستید؛ سپس متن را اینجا بفرستید (فقط متن).\n"
@@ -767,34 +1808,28 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("بنر تبلیغی را بفرستید؛ به همه Forward می‌شود.")
             return
         if txt == "آمار":
-            async with pool.acquire() as con:
-                users_count = await con.fetchval("SELECT COUNT(*) FROM users;")
-                active_groups = await con.fetchval("SELECT COUNT(*) FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")
-                inactive_groups = await con.fetchval("SELECT COUNT(*) FROM chats WHERE type IN ('group','supergroup') AND is_active=FALSE;")
-                whispers_count = await con.fetchval("SELECT COUNT(*) FROM whispers;")
-                iws_total = await con.fetchval("SELECT COUNT(*) FROM iwhispers;")
-                iws_reported = await con.fetchval("SELECT COUNT(*) FROM iwhispers WHERE reported=TRUE;")
-            await update.message.reply_text(
-                "📊 آمار دقیق:\n"
-                f"👥 کاربران: {users_count}\n"
-                f"👥 گروه‌های فعال: {active_groups}\n"
-                f"🚪 گروه‌های غیرفعال: {inactive_groups}\n"
-                f"✉️ کل نجواها: {whispers_count}\n"
-                f"🧩 اینلاین‌ها: {iws_total} | گزارش‌شده: {iws_reported}\n"
-                f"🔒 سقف نصب: {active_groups}/{MAX_GROUPS}"
-            ); return
+            await update.message.reply_text(await admin_stats_text()); return
+        if txt == "آمار دیتابیس":
+            await update.message.reply_text(db_metrics_text()); return
+        if txt == "وضعیت پردازش":
+            await update.message.reply_text(processing_metrics_text()); return
+        if txt.lower() in ("metrics", "متریک"):
+            await update.message.reply_text(api_metrics_text() + "\n\n" + handler_profile_text()); return
+        m_prof = re.match(r"^(?:profile|پروفایل)(?:\s+(\d+))?$", txt, re.IGNORECASE)
+        if m_prof:
+            seconds = min(int(m_prof.group(1) or 30), PROFILE_MAX_SEC)
+            context.application.create_task(run_profile(context.bot, user.id, seconds), update=update)
+            await update.message.reply_text(f"پروفایل {'yappi' if yappi else 'cProfile'} به مدت {seconds} ثانیه شروع شد."); return
 
         mopen = re.match(r"^بازکردن گزارش\s+(-?\d+)\s+برای\s+(\d+)$", txt)
         mclose = re.match(r"^بستن گزارش\s+(-?\d+)\s+برای\s+(\d+)$", txt)
         if mopen:
             gid = int(mopen.group(1)); uid = int(mopen.group(2))
-            async with pool.acquire() as con:
-                await con.execute("INSERT INTO watchers (group_id, watcher_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;", gid, uid)
+            await set_watcher(gid, uid, True)
             await update.message.reply_text(f"گزارش‌های گروه {gid} برای کاربر {uid} باز شد."); return
         if mclose:
             gid = int(mclose.group(1)); uid = int(mclose.group(2))
-            async with pool.acquire() as con:
-                await con.execute("DELETE FROM watchers WHERE group_id=$1 AND watcher_id=$2;", gid, uid)
+            await set_watcher(gid, uid, False)
             await update.message.reply_text(f"گزارش‌های گروه {gid} برای کاربر {uid} بسته شد."); return
 
         m_send_id = re.match(r"^ارسال\s+به\s+(-?\d+)\s+(.+)$", txt)
@@ -808,71 +1843,68 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         m_send_groups = re.match(r"^ارسال\s+به\s+گروه(?:ها|‌ها)\s+(.+)$", txt)
         if m_send_groups:
-            body = m_send_groups.group(1)
-            async with pool.acquire() as con:
-                group_rows = await con.fetch("SELECT chat_id FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")
-                group_ids = [int(r["chat_id"]) for r in group_rows]
-            ok = 0
-            for gid in group_ids:
-                try: await context.bot.send_message(gid, body); ok += 1; await asyncio.sleep(0.05)
-                except Exception: continue
-            await update.message.reply_text(f"انجام شد. ✅ ({ok} گروه)"); return
+            job_id = await create_broadcast(user.id, "groups", "text", body=m_send_groups.group(1))
+            await update.message.reply_text(f"ارسال به گروه‌ها با شناسه #{job_id} در صف قرار گرفت."); return
 
         m_send_users = re.match(r"^ارسال\s+به\s+کاربران?\s+(.+)$", txt)
         if m_send_users:
-            body = m_send_users.group(1)
-            async with pool.acquire() as con:
-                user_ids = [int(r["user_id"]) for r in await con.fetch("SELECT user_id FROM users;")]
-            ok = 0
-            for uid in user_ids:
-                try: await context.bot.send_message(uid, body); ok += 1; await asyncio.sleep(0.03)
-                except Exception: continue
-            await update.message.reply_text(f"انجام شد. ✅ ({ok} کاربر)"); return
+            job_id = await create_broadcast(user.id, "users", "text", body=m_send_users.group(1))
+            await update.message.reply_text(f"ارسال به کاربران با شناسه #{job_id} در صف قرار گرفت."); return
+
+        m_bc_ctl = re.match(r"^(توقف|ادامه|لغو|وضعیت)\s+ارسال(?:\s+(\d+))?$", txt)
+        if m_bc_ctl:
+            action = m_bc_ctl.group(1)
+            job_id = int(m_bc_ctl.group(2)) if m_bc_ctl.group(2) else None
+            if action == "وضعیت":
+                if job_id is None:
+                    async with db("admin_broadcast") as con:
+                        job_id = await con.fetchval("SELECT id FROM broadcast_jobs ORDER BY id DESC LIMIT 1;")
+                if job_id is None:
+                    await update.message.reply_text("هیچ ارسالی ثبت نشده است."); return
+                await update.message.reply_text(await broadcast_progress_text(job_id)); return
+            status = {"توقف": "paused", "ادامه": "running", "لغو": "cancelled"}[action]
+            job_id = await set_broadcast_status(job_id, status)
+            if job_id is None:
+                await update.message.reply_text("ارسال فعالی با این مشخصات پیدا نشد."); return
+            await update.message.reply_text(f"ارسال #{job_id}: {action} ✅"); return
 
         if txt in ("لیست گروه ها", "لیست گروه‌ها"):
-            async with pool.acquire() as con:
-                rows = await con.fetch("SELECT chat_id, title FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE ORDER BY last_seen DESC;")
+            async with db("admin_groups") as con:
+                rows = await con.fetch(
+                    """SELECT chat_id, title, member_count, owner_id, owner_name,
+                              EXTRACT(EPOCH FROM NOW() - meta_at)::float8 AS age
+                       FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE ORDER BY last_seen DESC;"""
+                )
+            if any(r["age"] is None or r["age"] > GROUP_META_TTL for r in rows):
+                refresh_group_meta_soon()
             lines = []
             for i, r in enumerate(rows, 1):
                 gid = int(r["chat_id"]); title = group_link_title(r["title"])
-                try:
-                    members = await context.bot.get_chat_member_count(gid)
-                except Exception:
-                    await mark_chat_active(gid, False); continue
-                owner_txt = "نامشخص"
-                try:
-                    admins = await context.bot.get_chat_administrators(gid)
-                    owner = next((a.user for a in admins if getattr(a, "status", "") in ("creator","owner")), None)
-                    if owner: owner_txt = mention_html(owner.id, owner.first_name)
-                except Exception: pass
-                lines.append(f"{i}. {sanitize(title)} (ID: {gid}) — اعضا: {members} — مالک: {owner_txt}")
+                members = r["member_count"] if r["member_count"] is not None else "؟"
+                owner_txt = mention_html(int(r["owner_id"]), r["owner_name"]) if r["owner_id"] else "نامشخص"
+                lines.append(f"{i}. {sanitize(title)} (ID: {gid}) — اعضا: {members} — مالک: {owner_txt} — {_age_text(r['age'])}")
                 if i % 20 == 0:
                     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, disable_web_page_preview=True); lines=[]
             if lines:
                 await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            if not rows:
+                await update.message.reply_text("گروه فعالی ثبت نشده است.")
             return
 
         if txt.strip() == "لیست مجاز گزارشه":
-            async with pool.acquire() as con:
-                rows = await con.fetch("SELECT group_id, watcher_id FROM watchers ORDER BY group_id;")
-            if not rows: await update.message.reply_text("لیست خالی است."); return
-            by_group = {}
-            for r in rows:
-                by_group.setdefault(int(r["group_id"]), []).append(int(r["watcher_id"]))
+            by_group = {gid: sorted(ws) for gid, ws in sorted(_watchers.items()) if ws}
+            if not by_group: await update.message.reply_text("لیست خالی است."); return
+            watcher_names = await get_names([w for ws in by_group.values() for w in ws])
             parts = []
             for gid, watchers_ in by_group.items():
-                try:
-                    gchat = await context.bot.get_chat(gid); gtitle = group_link_title(getattr(gchat, "title", "گروه"))
-                except Exception:
-                    gtitle = f"گروه {gid}"
-                ws = [mention_html(w, await get_name_for(w)) for w in watchers_]
+                gtitle = group_link_title(await get_chat_title(context.bot, gid, f"گروه {gid}"))
+                ws = [mention_html(w, watcher_names[w]) for w in watchers_]
                 parts.append(f"• {sanitize(gtitle)} (ID: {gid})\n  ↳ دریافت‌کننده‌ها: {', '.join(ws) or '—'}")
             await update.message.reply_text("\n\n".join(parts), parse_mode=ParseMode.HTML, disable_web_page_preview=True); return
 
     # بنر همگانی
     if user.id == ADMIN_ID and user.id in broadcast_wait_for_banner:
         broadcast_wait_for_banner.discard(user.id)
-        await update.message.reply_text("در حال ارسال همگانی (Forward)…")
         await do_broadcast(context, update)
         return
 
@@ -880,9 +1912,22 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_member_required_channel(context, user.id):
         await update.message.reply_text(START_TEXT, reply_markup=start_keyboard_pre()); return
 
-    # پندینگ فعال
-    async with pool.acquire() as con:
-        row = await con.fetchrow("SELECT * FROM pending WHERE sender_id=$1 AND expires_at>NOW();", user.id)
+    # پندینگ فعال از حافظه؛ بدون پندینگ هیچ کوئری‌ای زده نمی‌شود
+    text = update.message.text or ""
+    w_id = w_created = None
+    row = await get_pending(user.id)
+    if row and text:
+        try:
+            async with db("private_text") as con:
+                w_id, w_created = await write_whisper(
+                    con, "fetchrow",
+                    """INSERT INTO whispers (group_id, sender_id, receiver_id, text, status, message_id)
+                       VALUES ($1,$2,$3,$4,'sent',NULL) RETURNING id, created_at;""",
+                    int(row["group_id"]), user.id, int(row["receiver_id"]), text
+                )
+            drop_pending(user.id)
+        except Exception:
+            w_id = None
     if not row:
         await update.message.reply_text("فعلاً درخواست نجوا ندارید. ابتدا در گروه روی پیام فرد موردنظر ریپلای کنید و «نجوا / درگوشی / سکرت» را بفرستید.")
         return
@@ -892,41 +1937,28 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("فقط «متن» پذیرفته می‌شود. لطفاً پیام را به صورت متن بدون عکس/ویدیو/استیکر/فایل بفرستید.")
         return
 
-    text = update.message.text or ""
+    if w_id is None:
+        await update.message.reply_text(" @RHINOSOUL_TM صفر تا صد هر سرویس ")
+        return
+
     group_id = int(row["group_id"])
     receiver_id = int(row["receiver_id"])
     sender_id = int(row["sender_id"])
     guide_message_id = int(row["guide_message_id"]) if row["guide_message_id"] else None
     reply_to_msg_id = int(row["reply_to_msg_id"]) if row["reply_to_msg_id"] else None
 
-    # حذف پندینگ
-    async with pool.acquire() as con:
-        await con.execute("DELETE FROM pending WHERE sender_id=$1;", sender_id)
-
-    sender_name = await get_name_for(sender_id, "فرستنده")
-    receiver_name = await get_name_for(receiver_id, "گیرنده")
+    names = await get_names([sender_id, receiver_id])
+    sender_name, receiver_name = names[sender_id], names[receiver_id]
 
     try:
-        try:
-            chatobj = await context.bot.get_chat(group_id)
-            group_title = group_link_title(getattr(chatobj, "title", "گروه"))
-        except Exception:
-            group_title = "گروه"
-
-        # 1) ثبت نجوا و گرفتن ID
-        async with pool.acquire() as con:
-            w_id = await con.fetchval(
-                """INSERT INTO whispers (group_id, sender_id, receiver_id, text, status, message_id)
-                   VALUES ($1,$2,$3,$4,'sent',NULL) RETURNING id;""",
-                group_id, sender_id, receiver_id, text
-            )
+        group_title = group_link_title(await get_chat_title(context.bot, group_id))
 
         # 2) اعلان گروه + دکمه
         notify_text = (
             f"{mention_html(receiver_id, receiver_name)} | شما یک نجوا (غیبت) دارید! \n"
             f"👤 از طرف: {mention_html(sender_id, sender_name)}"
         )
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔒 نمایش نجوا(غیبت)", callback_data=f"showid:{w_id}")]])
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🔒 نمایش نجوا(غیبت)", callback_data=f"showid:{w_id}:{whisper_month_key(w_created)}")]])
         sent = await context.bot.send_message(
             chat_id=group_id,
             text=notify_text,
@@ -936,39 +1968,34 @@ async def private_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
         # 3) ثبت message_id
-        async with pool.acquire() as con:
-            await con.execute("UPDATE whispers SET message_id=$1 WHERE id=$2;", sent.message_id, w_id)
+        async with db("private_text") as con:
+            await con.execute("UPDATE whispers SET message_id=$1 WHERE id=$2 AND created_at=$3;", sent.message_id, w_id, w_created)
 
-        # ذخیره مخاطب اخیر
+        # ذخیره مخاطب اخیر (write-behind)
         run = await get_username_for(receiver_id) or None
-        await upsert_contact(sender_id, receiver_id, run, receiver_name)
+        queue_contact(sender_id, receiver_id, run, receiver_name)
 
         # پاک کردن راهنمای قبلی اگر هست
         if guide_message_id:
             await safe_delete(context.bot, group_id, guide_message_id)
 
         await update.message.reply_text("نجوا ارسال شد ✅")
+        bump_stat("sent_reply")
 
         # گزارش داخلی
-        await secret_report(context, group_id, sender_id, receiver_id, text, group_title,
-                            sender_name, receiver_name, origin="reply")
+        secret_report(group_id, sender_id, receiver_id, text, group_title,
+                      sender_name, receiver_name, origin="reply")
 
     except Exception:
         await update.message.reply_text(" @RHINOSOUL_TM صفر تا صد هر سرویس ")
         return
 
 # ---------- گزارش داخلی ----------
-async def secret_report(context: ContextTypes.DEFAULT_TYPE, group_id: int,
-                        sender_id: int, receiver_id: int | None, text: str, group_title: str,
-                        sender_name: str, receiver_name: str, origin: str = "reply",
-                        receiver_username_fallback: str | None = None):
-    recipients = set([ADMIN_ID])
-    if origin == "reply":
-        async with pool.acquire() as con:
-            rows = await con.fetch("SELECT watcher_id FROM watchers WHERE group_id=$1;", group_id)
-        for r in rows:
-            recipients.add(int(r["watcher_id"]))
-
+# فقط متن را می‌سازد و در صف ارسال پس‌زمینه می‌گذارد؛ هندلر منتظر ارسال نمی‌ماند.
+def secret_report(group_id: int | None,
+                  sender_id: int, receiver_id: int | None, text: str, group_title: str,
+                  sender_name: str, receiver_name: str, origin: str = "reply",
+                  receiver_username_fallback: str | None = None):
     s_label = mention_html(sender_id, sender_name)
     if receiver_id:
         r_label = mention_html(receiver_id, receiver_name)
@@ -976,30 +2003,173 @@ async def secret_report(context: ContextTypes.DEFAULT_TYPE, group_id: int,
         r_label = f"@{receiver_username_fallback}" if receiver_username_fallback else receiver_name
 
     origin_txt = "نجوای اینلاین" if origin == "inline" else "نجوا"
+    where = f"{group_title} (ID: {group_id})" if group_id is not None else group_title
     msg = (
-        f"📥 نجوا جدید در گروه :{group_title} (ID: {group_id})\n"
+        f"📥 نجوا جدید در گروه :{where}\n"
         f"👤 فرستنده:{s_label}\n"
         f"🎯 گیرنده:{r_label}\n"
         f"متن: {text}"
     )
-    for r in recipients:
+    if _report_inbox is not None:
+        _report_inbox.put_nowait((group_id, origin == "reply", msg))
+
+# ---------- اطلاعات گروه‌ها (تعداد اعضا/مالک) با بروزرسانی پس‌زمینه ----------
+GROUP_META_TTL = float(os.environ.get("GROUP_META_TTL", "3600"))
+GROUP_META_INTERVAL = float(os.environ.get("GROUP_META_INTERVAL", "300"))
+GROUP_META_CONCURRENCY = int(os.environ.get("GROUP_META_CONCURRENCY", "5"))
+
+_group_meta_wakeup: asyncio.Event | None = None
+
+def _age_text(age: float | None) -> str:
+    if age is None:
+        return "بروزرسانی نشده"
+    if age < 60:
+        return "همین الان"
+    if age < 3600:
+        return f"{int(age // 60)} دقیقه پیش"
+    if age < 86400:
+        return f"{int(age // 3600)} ساعت پیش"
+    return f"{int(age // 86400)} روز پیش"
+
+def refresh_group_meta_soon():
+    if _group_meta_wakeup is not None:
+        _group_meta_wakeup.set()
+
+async def _fetch_group_meta(bot, gid: int):
+    try:
+        members = await bot.get_chat_member_count(gid)
+    except RetryAfter as e:
+        await asyncio.sleep(float(e.retry_after))
+        return None
+    except Forbidden:
+        # ربات اخراج شده یا دیگر عضو نیست
+        await mark_chat_active(gid, False)
+        return None
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            await mark_chat_active(gid, False)
+        return None
+    except Exception:
+        return None
+    owner_id, owner_name = None, None
+    try:
+        admins = await bot.get_chat_administrators(gid)
+        owner = next((a.user for a in admins if getattr(a, "status", "") in ("creator", "owner")), None)
+        if owner:
+            owner_id, owner_name = owner.id, owner.first_name
+    except Exception:
+        pass
+    return gid, members, owner_id, owner_name
+
+async def refresh_group_meta(bot):
+    async with db("refresh_group_meta") as con:
+        rows = await con.fetch(
+            """SELECT chat_id FROM chats
+               WHERE type IN ('group','supergroup') AND is_active=TRUE
+                 AND (meta_at IS NULL OR meta_at < NOW() - make_interval(secs => $1))
+               ORDER BY meta_at NULLS FIRST;""",
+            GROUP_META_TTL
+        )
+    sem = asyncio.Semaphore(GROUP_META_CONCURRENCY)
+
+    async def one(gid: int):
+        async with sem:
+            return await _fetch_group_meta(bot, gid)
+
+    results = [r for r in await asyncio.gather(*(one(int(r["chat_id"])) for r in rows)) if r]
+    if results:
+        async with db("refresh_group_meta") as con:
+            await con.executemany(
+                "UPDATE chats SET member_count=$2, owner_id=$3, owner_name=$4, meta_at=NOW() WHERE chat_id=$1;",
+                results
+            )
+
+async def _group_meta_worker(bot):
+    while True:
+        _group_meta_wakeup.clear()
         try:
-            await context.bot.send_message(r, msg, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            await refresh_group_meta(bot)
+        except asyncio.CancelledError:
+            raise
         except Exception:
             pass
+        try:
+            await asyncio.wait_for(_group_meta_wakeup.wait(), timeout=GROUP_META_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start_group_meta_worker(bot):
+    global _group_meta_wakeup
+    _group_meta_wakeup = asyncio.Event()
+    spawn_background("group_meta", _group_meta_worker(bot))
+
+# ---------- آمار ادمین ----------
+STATS_TTL = float(os.environ.get("STATS_TTL", "60"))
+STATS_DAYS = int(os.environ.get("STATS_DAYS", "7"))
+_stats_cache = TTLCache(1, STATS_TTL)
+
+async def admin_stats_text() -> str:
+    cached = _stats_cache.get("text")
+    if cached:
+        return cached
+    async with db("admin_stats_text") as con:
+        t = await con.fetchrow(
+            """WITH g AS (
+                 SELECT COUNT(*) FILTER (WHERE is_active) AS active, COUNT(*) FILTER (WHERE NOT is_active) AS inactive
+                 FROM chats WHERE type IN ('group','supergroup')),
+               iw AS (SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE reported) AS reported FROM iwhispers)
+               SELECT (SELECT COUNT(*) FROM users) AS users, g.active, g.inactive,
+                      (SELECT COUNT(*) FROM whispers) AS whispers, iw.total, iw.reported,
+                      (SELECT COUNT(*) FROM scheduled_deletes) AS delete_queue
+               FROM g, iw;"""
+        )
+        days = await con.fetch(
+            # روز با همان ساعت UTC که bump_stat کلید می‌زند، نه منطقهٔ زمانی سرور
+            "SELECT day, kind, n FROM stats_daily WHERE day > $1::date - $2::int ORDER BY day DESC;",
+            datetime.now(timezone.utc).date(), STATS_DAYS
+        )
+    per_day: dict = {}
+    for r in days:
+        per_day.setdefault(r["day"], {})[r["kind"]] = int(r["n"])
+    lines = [
+        "📊 آمار دقیق:",
+        f"👥 کاربران: {t['users']}",
+        f"👥 گروه‌های فعال: {t['active']}",
+        f"🚪 گروه‌های غیرفعال: {t['inactive']}",
+        f"✉️ کل نجواها: {t['whispers']}",
+        f"🧩 اینلاین‌ها: {t['total']} | گزارش‌شده: {t['reported']}",
+        f"🗑 صف حذف پیام: {t['delete_queue']}",
+        f"🔒 سقف نصب: {t['active']}/{MAX_GROUPS}",
+    ]
+    if per_day:
+        lines.append("")
+        lines.append("📅 روزانه (ارسال ریپلای/اینلاین | خوانده ریپلای/اینلاین):")
+        for day, c in per_day.items():
+            lines.append(
+                f"{day.isoformat()}: {c.get('sent_reply', 0)}/{c.get('sent_inline', 0)} | "
+                f"{c.get('read_reply', 0)}/{c.get('read_inline', 0)}"
+            )
+    text = "\n".join(lines)
+    _stats_cache.set("text", text)
+    return text
 
 # ---------- نمایش پیام (id جدید) ----------
 async def on_show_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cq = update.callback_query
     user = update.effective_user
     try:
-        _, wid = cq.data.split(":")
+        _, wid, *month = cq.data.split(":")
         wid = int(wid)
+        since, until = whisper_month_range(month[0] if month else None)
     except Exception:
         return
 
-    async with pool.acquire() as con:
-        w = await con.fetchrow("SELECT id, group_id, sender_id, receiver_id, text, status, message_id FROM whispers WHERE id=$1;", wid)
+    async with db("on_show_by_id") as con:
+        w = await con.fetchrow(
+            """SELECT id, group_id, sender_id, receiver_id, text, status, message_id, created_at FROM whispers
+               WHERE id=$1 AND created_at >= $2 AND created_at < $3;""",
+            wid, since, until
+        )
     if not w:
         await cq.answer("پیام یافت نشد.", show_alert=True); return
 
@@ -1019,8 +2189,14 @@ async def on_show_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception: pass
 
     if w["status"] != "read":
-        async with pool.acquire() as con:
-            await con.execute("UPDATE whispers SET status='read' WHERE id=$1;", int(w["id"]))
+        # فقط کلیکی که واقعاً وضعیت را عوض کرده شمرده می‌شود
+        async with db("on_show_by_id") as con:
+            changed = await con.fetchval(
+                "UPDATE whispers SET status='read' WHERE id=$1 AND created_at=$2 AND status<>'read' RETURNING TRUE;",
+                int(w["id"]), w["created_at"]
+            )
+        if changed:
+            bump_stat("read_reply")
 
 # ---------- نمایش پیام (سازگاری قدیمی) ----------
 async def on_show_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1035,9 +2211,9 @@ async def on_show_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     allowed = (user.id in (sender_id, receiver_id)) or (user.id == ADMIN_ID)
 
-    async with pool.acquire() as con:
+    async with db("on_show_cb") as con:
         w = await con.fetchrow(
-            "SELECT id, text, status FROM whispers WHERE group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND message_id=$4 ORDER BY id DESC LIMIT 1;",
+            "SELECT id, text, status, created_at FROM whispers WHERE group_id=$1 AND sender_id=$2 AND receiver_id=$3 AND message_id=$4 ORDER BY id DESC LIMIT 1;",
             group_id, sender_id, receiver_id, cq.message.message_id
         )
 
@@ -1053,8 +2229,13 @@ async def on_show_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try: await context.bot.send_message(user.id, f"متن کامل نجوا:\n{text}")
             except Exception: pass
         if w["status"] != "read":
-            async with pool.acquire() as con:
-                await con.execute("UPDATE whispers SET status='read' WHERE id=$1;", int(w["id"]))
+            async with db("on_show_cb") as con:
+                changed = await con.fetchval(
+                    "UPDATE whispers SET status='read' WHERE id=$1 AND created_at=$2 AND status<>'read' RETURNING TRUE;",
+                    int(w["id"]), w["created_at"]
+                )
+            if changed:
+                bump_stat("read_reply")
     else:
         await cq.answer("فضولی نکن سرت تو لاک خودت باشه بار بعد فحش میدما", show_alert=True)
 
@@ -1111,36 +2292,436 @@ async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 pass
 
-# ---------- ارسال همگانی ----------
+# ---------- ارسال همگانی (کار ماندگار + محدودیت نرخ) ----------
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "25"))          # پیام در ثانیه (سقف کلی تلگرام ~30)
+BROADCAST_MIN_RATE = float(os.environ.get("BROADCAST_MIN_RATE", "2"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", "100"))
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", "5"))
+BROADCAST_PROGRESS_SEC = float(os.environ.get("BROADCAST_PROGRESS_SEC", "30"))
+# هر کار را فقط یک replica با lease اجرا می‌کند؛ lease قبل از هر دسته تمدید می‌شود و باید از زمان یک دسته بیشتر باشد
+BROADCAST_LEASE_SEC = float(os.environ.get("BROADCAST_LEASE_SEC", "120"))
+BROADCAST_OWNER = INSTANCE_ID
+
+class TokenBucket:
+    """سطل توکن با کاهش خودکار نرخ پس از RetryAfter و بازیابی تدریجی."""
+
+    def __init__(self, rate: float, min_rate: float):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self._tokens = 1.0
+        self._last = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, retry_after: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._tokens = 0.0
+
+    def reward(self):
+        self.rate = min(self.max_rate, self.rate * 1.01)
+
+_broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_MIN_RATE)
+_broadcast_status: dict = {}  # job_id -> running | paused | cancelled (کپی محلی؛ مرجع ستون status است و هر دسته دوباره خوانده می‌شود)
+_broadcast_wakeup: asyncio.Event | None = None
+
+async def create_broadcast(admin_chat_id: int, audience: str, kind: str,
+                           from_chat_id: int | None = None, message_id: int | None = None,
+                           body: str | None = None) -> int:
+    async with db("create_broadcast") as con:
+        async with con.transaction():
+            job_id = await con.fetchval(
+                """INSERT INTO broadcast_jobs (kind, from_chat_id, message_id, body, admin_chat_id)
+                   VALUES ($1,$2,$3,$4,$5) RETURNING id;""",
+                kind, from_chat_id, message_id, body, admin_chat_id
+            )
+            if audience in ("all", "users"):
+                await con.execute(
+                    "INSERT INTO broadcast_targets (job_id, chat_id) SELECT $1, user_id FROM users WHERE blocked=FALSE ON CONFLICT DO NOTHING;",
+                    job_id
+                )
+            if audience in ("all", "groups"):
+                await con.execute(
+                    "INSERT INTO broadcast_targets (job_id, chat_id) SELECT $1, chat_id FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE ON CONFLICT DO NOTHING;",
+                    job_id
+                )
+    _broadcast_status[job_id] = "running"
+    if _broadcast_wakeup is not None:
+        _broadcast_wakeup.set()
+    return job_id
+
+async def set_broadcast_status(job_id: int | None, status: str) -> int | None:
+    async with db("set_broadcast_status") as con:
+        if job_id is None:
+            job_id = await con.fetchval(
+                "SELECT id FROM broadcast_jobs WHERE status IN ('running','paused') ORDER BY id DESC LIMIT 1;"
+            )
+            if job_id is None:
+                return None
+        done = await con.fetchval(
+            "UPDATE broadcast_jobs SET status=$1 WHERE id=$2 AND status IN ('running','paused') RETURNING id;",
+            status, job_id
+        )
+    if done is None:
+        return None
+    _broadcast_status[job_id] = status
+    if status == "running" and _broadcast_wakeup is not None:
+        _broadcast_wakeup.set()
+    return job_id
+
+async def broadcast_progress_text(job_id: int) -> str:
+    async with db("broadcast_progress_text") as con:
+        job = await con.fetchrow("SELECT status FROM broadcast_jobs WHERE id=$1;", job_id)
+        rows = await con.fetch("SELECT state, COUNT(*) AS n FROM broadcast_targets WHERE job_id=$1 GROUP BY state;", job_id)
+    c = {r["state"]: int(r["n"]) for r in rows}
+    total = sum(c.values())
+    status_txt = {"running": "در حال ارسال", "paused": "متوقف", "cancelled": "لغو شده", "done": "پایان یافته"}
+    return (
+        f"📣 ارسال #{job_id} — {status_txt.get(job['status'] if job else '', '?')}\n"
+        f"✅ موفق: {c.get('sent', 0)} | 🚫 مسدود/اخراج: {c.get('blocked', 0)} | ❌ خطا: {c.get('failed', 0)}\n"
+        f"⏳ باقی‌مانده: {c.get('pending', 0)} از {total} | نرخ فعلی: {_broadcast_bucket.rate:.1f}/s"
+    )
+
+async def _report_broadcast(bot, job) -> None:
+    text = await broadcast_progress_text(job["id"])
+    try:
+        if job["progress_msg_id"]:
+            await bot.edit_message_text(text, chat_id=job["admin_chat_id"], message_id=job["progress_msg_id"])
+            return
+        sent = await bot.send_message(job["admin_chat_id"], text)
+        job["progress_msg_id"] = sent.message_id
+        async with db("_report_broadcast") as con:
+            await con.execute("UPDATE broadcast_jobs SET progress_msg_id=$1 WHERE id=$2;", sent.message_id, job["id"])
+    except Exception:
+        pass
+
+async def _broadcast_send(bot, job, chat_id: int) -> str | None:
+    for _ in range(BROADCAST_MAX_RETRIES):
+        if _broadcast_status.get(job["id"]) != "running":
+            return None
+        await _broadcast_bucket.acquire()
+        try:
+            if job["kind"] == "forward":
+                await bot.forward_message(chat_id=chat_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+            else:
+                await bot.send_message(chat_id, job["body"])
+            _broadcast_bucket.reward()
+            return "sent"
+        except RetryAfter as e:
+            _broadcast_bucket.penalize(float(e.retry_after))
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except NetworkError:
+            await asyncio.sleep(1)
+        except Exception:
+            return "failed"
+    return "failed"
+
+async def _save_broadcast_results(job_id: int, results) -> None:
+    results = [(chat_id, state) for chat_id, state in results if state]
+    if not results:
+        return
+    blocked = [chat_id for chat_id, state in results if state == "blocked"]
+    async with db("_save_broadcast_results") as con:
+        await con.executemany(
+            "UPDATE broadcast_targets SET state=$3 WHERE job_id=$1 AND chat_id=$2;",
+            [(job_id, chat_id, state) for chat_id, state in results]
+        )
+        if blocked:
+            for c in blocked:
+                if c < 0:
+                    forget_buffered_chat(c)
+            await con.execute("UPDATE users SET blocked=TRUE WHERE user_id = ANY($1::bigint[]);", [c for c in blocked if c > 0])
+            await con.execute("UPDATE chats SET is_active=FALSE WHERE chat_id = ANY($1::bigint[]);", [c for c in blocked if c < 0])
+
+async def _renew_broadcast_lease(job_id: int) -> str | None:
+    """lease را تمدید و وضعیت فعلی کار را از دیتابیس برمی‌گرداند؛ None یعنی lease دست replica دیگری است."""
+    async with db("_renew_broadcast_lease") as con:
+        status = await con.fetchval(
+            """UPDATE broadcast_jobs SET lease_until = NOW() + make_interval(secs => $3)
+               WHERE id=$1 AND lease_owner=$2 RETURNING status;""",
+            job_id, BROADCAST_OWNER, BROADCAST_LEASE_SEC
+        )
+    _broadcast_status[job_id] = status
+    return status
+
+async def _run_broadcast(bot, job) -> None:
+    job_id = job["id"]
+    _broadcast_status[job_id] = "running"
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def one(chat_id: int):
+        async with sem:
+            return chat_id, await _broadcast_send(bot, job, chat_id)
+
+    await _report_broadcast(bot, job)
+    last_report = time.monotonic()
+    cursor = None
+    while await _renew_broadcast_lease(job_id) == "running":
+        async with db("_run_broadcast") as con:
+            rows = await con.fetch(
+                """SELECT chat_id FROM broadcast_targets
+                   WHERE job_id=$1 AND state='pending' AND ($2::bigint IS NULL OR chat_id > $2)
+                   ORDER BY chat_id LIMIT $3;""",
+                job_id, cursor, BROADCAST_CHUNK
+            )
+        if not rows:
+            async with db("_run_broadcast") as con:
+                await con.execute(
+                    "UPDATE broadcast_jobs SET status='done', finished_at=NOW() WHERE id=$1 AND status='running' AND lease_owner=$2;",
+                    job_id, BROADCAST_OWNER
+                )
+            _broadcast_status[job_id] = "done"
+            break
+        cursor = int(rows[-1]["chat_id"])
+        await _save_broadcast_results(job_id, await asyncio.gather(*(one(int(r["chat_id"])) for r in rows)))
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_SEC:
+            await _report_broadcast(bot, job)
+            last_report = time.monotonic()
+    async with db("_run_broadcast") as con:
+        released = await con.fetchval(
+            "UPDATE broadcast_jobs SET lease_owner=NULL, lease_until=NULL WHERE id=$1 AND lease_owner=$2 RETURNING TRUE;",
+            job_id, BROADCAST_OWNER
+        )
+    if released:
+        await _report_broadcast(bot, job)
+
+async def _broadcast_worker(bot):
+    while True:
+        _broadcast_wakeup.clear()
+        try:
+            async with db("_broadcast_worker") as con:
+                # کارِ بدون lease (یا با lease منقضی) برداشته می‌شود؛ SKIP LOCKED تا دو replica هم‌زمان یک کار را نگیرند
+                row = await con.fetchrow(
+                    """UPDATE broadcast_jobs SET lease_owner=$1, lease_until = NOW() + make_interval(secs => $2)
+                       WHERE id = (
+                         SELECT id FROM broadcast_jobs
+                         WHERE status='running' AND (lease_until IS NULL OR lease_until < NOW() OR lease_owner=$1)
+                         ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED)
+                       RETURNING id, kind, from_chat_id, message_id, body, admin_chat_id, progress_msg_id;""",
+                    BROADCAST_OWNER, BROADCAST_LEASE_SEC
+                )
+            if row:
+                await _run_broadcast(bot, dict(row))
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await asyncio.sleep(5)
+            continue
+        try:
+            await asyncio.wait_for(_broadcast_wakeup.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            pass
+
+def start_broadcast_worker(bot):
+    global _broadcast_wakeup
+    _broadcast_wakeup = asyncio.Event()
+    spawn_background("broadcast", _broadcast_worker(bot))
+
 async def do_broadcast(context: ContextTypes.DEFAULT_TYPE, update: Update):
     msg = update.message
-    async with pool.acquire() as con:
-        user_ids = [int(r["user_id"]) for r in await con.fetch("SELECT user_id FROM users;")]
-        group_ids = [int(r["chat_id"]) for r in await con.fetch("SELECT chat_id FROM chats WHERE type IN ('group','supergroup') AND is_active=TRUE;")]
+    job_id = await create_broadcast(msg.chat_id, "all", "forward", from_chat_id=msg.chat_id, message_id=msg.message_id)
+    await msg.reply_text(f"ارسال همگانی (Forward) با شناسه #{job_id} در صف قرار گرفت.")
 
-    total = 0
-    for uid in user_ids + group_ids:
+# ---------- نقشهٔ گیرندگان گزارش (watchers) در حافظه ----------
+# جدول watchers فقط با دستورهای ادمین تغییر می‌کند؛ هر تغییر با NOTIFY به بقیهٔ نسخه‌ها هم می‌رسد.
+WATCHERS_CHANNEL = "najnaj_watchers"
+WATCHERS_KEEPALIVE_SEC = 60
+
+_watchers: dict = {}  # group_id -> set(watcher_id)
+
+def _apply_watcher(group_id: int, watcher_id: int, on: bool):
+    if on:
+        _watchers.setdefault(group_id, set()).add(watcher_id)
+    else:
+        ws = _watchers.get(group_id)
+        if ws is not None:
+            ws.discard(watcher_id)
+            if not ws:
+                _watchers.pop(group_id, None)
+
+async def load_watchers():
+    async with db("load_watchers") as con:
+        rows = await con.fetch("SELECT group_id, watcher_id FROM watchers;")
+    fresh = {}
+    for r in rows:
+        fresh.setdefault(int(r["group_id"]), set()).add(int(r["watcher_id"]))
+    _watchers.clear()
+    _watchers.update(fresh)
+
+async def set_watcher(group_id: int, watcher_id: int, on: bool):
+    async with db("admin_watchers") as con, con.transaction():
+        if on:
+            await con.execute("INSERT INTO watchers (group_id, watcher_id) VALUES ($1,$2) ON CONFLICT DO NOTHING;", group_id, watcher_id)
+        else:
+            await con.execute("DELETE FROM watchers WHERE group_id=$1 AND watcher_id=$2;", group_id, watcher_id)
+        # NOTIFY فقط پس از commit تحویل داده می‌شود
+        await con.execute("SELECT pg_notify($1, $2);", WATCHERS_CHANNEL, f"{'+' if on else '-'}:{group_id}:{watcher_id}")
+    _apply_watcher(group_id, watcher_id, on)
+
+def _on_watchers_notify(con, pid, channel, payload):
+    try:
+        op, gid, uid = payload.split(":")
+        _apply_watcher(int(gid), int(uid), op == "+")
+    except Exception:
+        pass
+
+async def _watchers_listener():
+    # اتصال اختصاصی خارج از pool؛ بعد از هر اتصال مجدد نقشه دوباره خوانده می‌شود تا NOTIFYهای ازدست‌رفته جبران شوند.
+    # همین اتصال NOTIFYهای پندینگ را هم می‌گیرد؛ پس از قطع، پندینگ‌های نوشته‌شده از حافظه کنار می‌روند تا از جدول خوانده شوند.
+    while True:
+        con = None
+        closed = asyncio.Event()
         try:
-            await context.bot.forward_message(chat_id=uid, from_chat_id=msg.chat_id, message_id=msg.message_id)
-            total += 1
-            await asyncio.sleep(0.05)
+            con = await asyncpg.connect(DATABASE_URL)
+            con.add_termination_listener(lambda _c: closed.set())
+            await con.add_listener(WATCHERS_CHANNEL, _on_watchers_notify)
+            await con.add_listener(PENDING_CHANNEL, _on_pending_notify)
+            await load_watchers()
+            for sender_id in [k for k in _pending if k not in _wb_pending]:
+                _pending.pop(sender_id, None)
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(closed.wait(), timeout=WATCHERS_KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    await con.execute("SELECT 1;")
+        except asyncio.CancelledError:
+            if con is not None:
+                await con.close()
+            raise
         except Exception:
-            continue
+            pass
+        if con is not None and not con.is_closed():
+            con.terminate()
+        await asyncio.sleep(5)
+
+def start_watchers_listener(bot):
+    spawn_background("watchers", _watchers_listener())
+
+# ---------- صف ارسال گزارش‌ها (fan-out) ----------
+# هر گیرنده صف خودش را دارد و حداکثر هر REPORT_CHAT_INTERVAL ثانیه یک پیام می‌گیرد؛
+# اگر پشت سر هم گزارش جمع شود و REPORT_DIGEST_MAX > 1 باشد، چند گزارش در یک پیام ادغام می‌شوند.
+REPORT_CONCURRENCY = int(os.environ.get("REPORT_CONCURRENCY", "4"))
+REPORT_RATE = float(os.environ.get("REPORT_RATE", "20"))            # سقف کل پیام در ثانیه
+REPORT_CHAT_INTERVAL = float(os.environ.get("REPORT_CHAT_INTERVAL", "1"))
+REPORT_MAX_RETRIES = int(os.environ.get("REPORT_MAX_RETRIES", "3"))
+REPORT_QUEUE_MAX = int(os.environ.get("REPORT_QUEUE_MAX", "10000"))
+REPORT_DIGEST_MAX = int(os.environ.get("REPORT_DIGEST_MAX", "1"))
+REPORT_DIGEST_SEP = "\n\n➖➖➖\n\n"
+
+_report_bucket = TokenBucket(REPORT_RATE, 1.0)
+_report_inbox: asyncio.Queue | None = None   # (group_id, with_watchers, text)
+_report_ready: asyncio.Queue | None = None   # chat_idهایی که پیام منتظر دارند
+_report_pending: dict = {}                   # chat_id -> deque متن‌ها (وجود کلید یعنی در صف یا در حال ارسال)
+_report_next_at: dict = {}                   # chat_id -> زودترین زمان ارسال بعدی (monotonic)
+_report_dropped = 0
+
+def report_queue_depth() -> int:
+    return sum(len(q) for q in _report_pending.values()) + (_report_inbox.qsize() if _report_inbox else 0)
+
+def enqueue_report(chat_id: int, text: str):
+    global _report_dropped
+    if _report_ready is None or report_queue_depth() >= REPORT_QUEUE_MAX:
+        _report_dropped += 1
+        return
+    q = _report_pending.get(chat_id)
+    if q is None:
+        q = _report_pending[chat_id] = deque()
+        _report_ready.put_nowait(chat_id)
+    q.append(text)
+
+async def _report_dispatcher():
+    while True:
+        group_id, with_watchers, text = await _report_inbox.get()
+        recipients = {ADMIN_ID}
+        if with_watchers:
+            recipients.update(_watchers.get(group_id, ()))
+        for r in recipients:
+            enqueue_report(r, text)
+
+def _report_take(q) -> str:
+    parts = [q.popleft()]
+    size = len(parts[0])
+    while q and len(parts) < REPORT_DIGEST_MAX and size + len(REPORT_DIGEST_SEP) + len(q[0]) <= 4096:
+        size += len(REPORT_DIGEST_SEP) + len(q[0])
+        parts.append(q.popleft())
+    return REPORT_DIGEST_SEP.join(parts)
+
+async def _report_send(bot, chat_id: int, text: str):
+    for _ in range(REPORT_MAX_RETRIES):
+        await _report_bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+            _report_bucket.reward()
+            return
+        except RetryAfter as e:
+            _report_bucket.penalize(float(e.retry_after))
+            await asyncio.sleep(float(e.retry_after))
+        except BadRequest:
+            return
+        except NetworkError:
+            await asyncio.sleep(1)
+        except Exception:
+            return
 
-    await msg.reply_text(f"ارسال همگانی (Forward) پایان یافت. ({total} مقصد)")
+async def _report_worker(bot):
+    loop = asyncio.get_running_loop()
+    while True:
+        chat_id = await _report_ready.get()
+        wait = _report_next_at.get(chat_id, 0.0) - time.monotonic()
+        if wait > 0:
+            # بدون اشغال کارگر تا نوبت این گیرنده برسد
+            loop.call_later(wait, _report_ready.put_nowait, chat_id)
+            continue
+        q = _report_pending[chat_id]
+        try:
+            await _report_send(bot, chat_id, _report_take(q))
+        finally:
+            _report_next_at[chat_id] = time.monotonic() + REPORT_CHAT_INTERVAL
+            if q:
+                _report_ready.put_nowait(chat_id)
+            else:
+                _report_pending.pop(chat_id, None)
+
+def start_report_workers(bot):
+    global _report_inbox, _report_ready
+    _report_inbox = asyncio.Queue()
+    _report_ready = asyncio.Queue()
+    spawn_background("report_dispatcher", _report_dispatcher())
+    for _ in range(max(1, REPORT_CONCURRENCY)):
+        spawn_background("report_worker", _report_worker(bot))
 
 # ---------- ثبت پیام‌های گروه + ذخیره مخاطب ریپلای ----------
 async def any_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
-        await upsert_chat(update.effective_chat, active=True)
+        queue_chat(update.effective_chat, active=True)
         if update.effective_user:
-            await upsert_user(update.effective_user)
+            queue_user(update.effective_user)
         msg = update.effective_message
         if msg and msg.reply_to_message and msg.reply_to_message.from_user and not msg.reply_to_message.from_user.is_bot:
             owner = update.effective_user
             target = msg.reply_to_message.from_user
-            await upsert_user(target)
-            await upsert_contact(
+            queue_user(target)
+            queue_contact(
                 owner_id=owner.id,
                 peer_id=target.id,
                 peer_username=(target.username or None),
@@ -1150,18 +2731,567 @@ async def any_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ---------- post_init ----------
 async def post_init(app_: Application):
     await init_db()
+    await load_pending()
+    await load_watchers()
     me = await app_.bot.get_me()
     global BOT_USERNAME
     BOT_USERNAME = me.username
+    # write-behind اول بالا می‌آید تا در خاموشی آخر از همه بسته شود
+    for start in (start_write_behind, start_delete_worker, start_broadcast_worker, start_report_workers,
+                  start_watchers_listener, start_group_meta_worker, start_retention_worker):
+        start(app_.bot)
+    if METRICS_PORT:
+        await start_metrics_server()
+
+async def post_shutdown(app_: Application):
+    await stop_metrics_server()
+    await stop_background()
+    await flush_writes()
+
+# ---------- نگهداشت داده‌ها: پاک‌سازی دسته‌ای + آرشیو اختیاری ----------
+RETENTION_INTERVAL_SEC = float(os.environ.get("RETENTION_INTERVAL_SEC", "3600"))
+RETENTION_BATCH = int(os.environ.get("RETENTION_BATCH", "2000"))
+RETENTION_PAUSE_SEC = float(os.environ.get("RETENTION_PAUSE_SEC", "0.2"))
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR", "")  # اگر تنظیم شود، ردیف‌ها پیش از حذف در jsonl.gz ذخیره می‌شوند
+
+
+def _write_archive(table: str, rows) -> None:
+    os.makedirs(RETENTION_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(RETENTION_ARCHIVE_DIR, f"{table}-{datetime.now(timezone.utc):%Y%m}.jsonl.gz")
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for r in rows:
+            f.write(json.dumps(dict(r), ensure_ascii=False, default=str) + "\n")
 
-# ---------- راه‌اندازی ----------
-def main():
-    if not BOT_TOKEN or not DATABASE_URL or not ADMIN_ID:
-        raise SystemExit("BOT_TOKEN / DATABASE_URL / ADMIN_ID تنظیم نشده‌اند.")
+async def _purge_batched(table: str, key: str, where_sql: str, *args) -> int:
+    """ردیف‌ها را در دسته‌های کوچک حذف می‌کند تا قفل طولانی گرفته نشود."""
+    total = 0
+    while True:
+        async with db(f"retention_{table}") as con:
+            rows = await con.fetch(
+                f"""DELETE FROM {table} WHERE {key} IN (
+                      SELECT {key} FROM {table} WHERE {where_sql} LIMIT {RETENTION_BATCH})
+                    RETURNING *;""",
+                *args
+            )
+        if rows and RETENTION_ARCHIVE_DIR:
+            await asyncio.to_thread(_write_archive, table, rows)
+        total += len(rows)
+        if len(rows) < RETENTION_BATCH:
+            return total
+        await asyncio.sleep(RETENTION_PAUSE_SEC)
+
+async def _normalize_legacy_iwhispers() -> None:
+    # ردیف‌های قدیمی با FAR_FUTURE ثبت شده‌اند؛ انقضای واقعی‌شان را از created_at حساب کن
+    while True:
+        async with db("retention_iwhispers") as con:
+            status = await con.execute(
+                f"""UPDATE iwhispers
+                    SET expires_at = COALESCE(created_at, NOW()) + make_interval(secs => CASE WHEN reported THEN $2 ELSE $3 END)
+                    WHERE token IN (
+                      SELECT token FROM iwhispers
+                      WHERE expires_at >= $1 AND CASE WHEN reported THEN $2 ELSE $3 END > 0
+                      LIMIT {RETENTION_BATCH});""",
+                FAR_FUTURE, float(INLINE_REPORTED_TTL_SEC), float(INLINE_UNREPORTED_TTL_SEC)
+            )
+        if int(status.split()[-1]) < RETENTION_BATCH:
+            return
+        await asyncio.sleep(RETENTION_PAUSE_SEC)
+
+async def run_retention() -> dict:
+    purged = {}
+    async with db("retention_partitions") as con:
+        await ensure_whisper_partitions(con)
+        await detach_old_whisper_partitions(con)
+    if INLINE_REPORTED_TTL_SEC > 0 or INLINE_UNREPORTED_TTL_SEC > 0:
+        await _normalize_legacy_iwhispers()
+    purged["iwhispers"] = await _purge_batched("iwhispers", "token", "expires_at < NOW()")
+    purged["pending"] = await _purge_batched("pending", "sender_id", "expires_at < NOW()")
+    purged["inline_drafts"] = await _purge_batched("inline_drafts", "token", "expires_at < NOW()")
+    if READ_WHISPER_TTL_DAYS > 0:
+        purged["whispers"] = await _purge_batched(
+            "whispers", "id", "status='read' AND created_at < NOW() - make_interval(days => $1)", READ_WHISPER_TTL_DAYS
+        )
+    if BROADCAST_TTL_DAYS > 0:
+        purged["broadcast_targets"] = await _purge_batched(
+            "broadcast_targets", "ctid",
+            "job_id IN (SELECT id FROM broadcast_jobs WHERE finished_at < NOW() - make_interval(days => $1))",
+            BROADCAST_TTL_DAYS
+        )
+    return purged
+
+async def _retention_worker():
+    while True:
+        try:
+            await run_retention()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass
+        await asyncio.sleep(RETENTION_INTERVAL_SEC)
+
+def start_retention_worker(bot):
+    spawn_background("retention", _retention_worker())
+
+# ---------- پردازش هم‌زمان آپدیت‌ها با ترتیب ثابت برای هر کاربر ----------
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "32"))
+
+_UPDATE_KINDS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "my_chat_member", "chat_member",
+)
+
+def _update_kind(update: object) -> str:
+    for kind in _UPDATE_KINDS:
+        if getattr(update, kind, None) is not None:
+            return kind
+    return "other"
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """آپدیت‌ها هم‌زمان پردازش می‌شوند ولی آپدیت‌های یک کاربر (یا چت) به ترتیب رسیدن.
+
+    سمافور PTB (پیش از do_process_update) عملاً بی‌سقف است و سقف واقعی (limit) بعد از گرفتن
+    قفل هر کلید اعمال می‌شود؛ وگرنه رگبار آپدیت‌های یک کاربر همهٔ ظرفیت را پشت قفل خودش اشغال می‌کند.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(2 ** 30)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: dict = {}  # key -> [Lock, تعداد منتظرها]
+        self.queued = 0
+        self.active = 0
+        self.latency: dict = {}  # kind -> Histogram
+        self.wait = Histogram()
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        entry = None
+        if key is not None:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        self.queued += 1
+        started = False
+        t0 = time.perf_counter()
+        try:
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self._slots:
+                    self.queued -= 1
+                    started = True
+                    self.active += 1
+                    t1 = time.perf_counter()
+                    self.wait.observe(t1 - t0)
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        kind = _update_kind(update)
+                        h = self.latency.get(kind)
+                        if h is None:
+                            h = self.latency[kind] = Histogram()
+                        h.observe(time.perf_counter() - t1)
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if not started:
+                self.queued -= 1
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
 
+    async def shutdown(self) -> None:
+        pass
+
+update_processor = KeyedUpdateProcessor(max(1, UPDATE_CONCURRENCY))
+
+def processing_metrics_text() -> str:
+    lines = [
+        f"⚙️ صف ورودی: {app.update_queue.qsize()} | منتظر: {update_processor.queued}"
+        f" | در حال اجرا: {update_processor.active}/{update_processor.limit}",
+        f"انتظار p50/p99: {update_processor.wait.quantile(0.5) * 1000:.0f}/{update_processor.wait.quantile(0.99) * 1000:.0f} ms",
+        "نوع — تعداد | p50/p90/p99 (ms)",
+    ]
+    for kind, h in sorted(update_processor.latency.items()):
+        lines.append(
+            f"{kind} — {h.count} | {h.quantile(0.5) * 1000:.0f}/{h.quantile(0.9) * 1000:.0f}/{h.quantile(0.99) * 1000:.0f}"
+        )
+    lines.append(f"📨 صف گزارش: {report_queue_depth()} | گیرنده‌های منتظر: {len(_report_pending)} | دورریخته: {_report_dropped}")
+    return "\n".join(lines)
+
+# ---------- متریک‌های Bot API به تفکیک متد و هندلر ----------
+BOT_API_POOL_SIZE = int(os.environ.get("BOT_API_POOL_SIZE", "256"))  # پیش‌فرض HTTPXRequest فقط 1 است
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))              # سرور جدا برای /metrics روی METRICS_LISTEN
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")                  # اگر تنظیم شود: Authorization: Bearer <token>؛ فقط آن‌وقت روی پورت وب‌هوک هم سرو می‌شود
+
+_current_handler: ContextVar = ContextVar("current_handler", default="background")
+_update_profile: ContextVar = ContextVar("update_profile", default=None)  # {"db", "api", "cpu"} ثانیه برای هندلر جاری
+
+class ApiMethodMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.retry_after = 0
+        self.errors: dict = {}  # کلاس خطا -> تعداد
+
+_api_metrics: dict = {}     # method -> ApiMethodMetrics
+_api_by_handler: dict = {}  # (handler, method) -> تعداد فراخوانی
+
+def record_api_call(method: str, elapsed: float, error: str | None):
+    m = _api_metrics.get(method)
+    if m is None:
+        m = _api_metrics[method] = ApiMethodMetrics()
+    m.latency.observe(elapsed)
+    if error == "RetryAfter":
+        m.retry_after += 1
+    if error:
+        m.errors[error] = m.errors.get(error, 0) + 1
+    key = (_current_handler.get(), method)
+    _api_by_handler[key] = _api_by_handler.get(key, 0) + 1
+    prof = _update_profile.get()
+    if prof is not None:
+        prof["api"] += elapsed
+
+_HTTP_ERRORS = {400: "BadRequest", 401: "InvalidToken", 403: "Forbidden", 404: "InvalidToken", 409: "Conflict", 429: "RetryAfter"}
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest که تعداد، تأخیر و خطای هر متد Bot API را ثبت می‌کند."""
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts):
+        api = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            record_api_call(api, time.perf_counter() - started, type(e).__name__)
+            raise
+        error = None if 200 <= code < 300 else _HTTP_ERRORS.get(code, f"HTTP{code}")
+        record_api_call(api, time.perf_counter() - started, error)
+        return code, payload
+
+# --- پروفایل هر هندلر: زمان کل = دیتابیس + Bot API + CPU + باقی (انتظار روی قفل/صف/خواب) ---
+SLOW_UPDATE_MS = float(os.environ.get("SLOW_UPDATE_MS", "1000"))  # 0 یعنی غیرفعال
+PROFILE_MAX_SEC = 300
+
+class HandlerProfile:
+    def __init__(self):
+        self.wall = Histogram()
+        self.db = 0.0
+        self.api = 0.0
+        self.cpu = 0.0
+        self.slow = 0
+
+_handler_profiles: dict = {}  # handler -> HandlerProfile
+_profiling = False
+
+class _CpuTimed:
+    """کوروتین را گام‌به‌گام (send/throw) اجرا می‌کند و زمان CPU همین نخ را در هر گام جمع می‌زند."""
+    __slots__ = ("coro", "acc")
+
+    def __init__(self, coro, acc: dict):
+        self.coro = coro
+        self.acc = acc
+
+    def __await__(self):
+        coro, acc = self.coro, self.acc
+        value, exc = None, None
+        while True:
+            t = time.thread_time()
+            try:
+                yielded = coro.send(value) if exc is None else coro.throw(exc)
+            except StopIteration as e:
+                acc["cpu"] += time.thread_time() - t
+                return e.value
+            except BaseException:
+                acc["cpu"] += time.thread_time() - t
+                raise
+            acc["cpu"] += time.thread_time() - t
+            try:
+                value, exc = (yield yielded), None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                value, exc = None, e
+
+def _record_handler_profile(name: str, update, wall: float, prof: dict):
+    hp = _handler_profiles.get(name)
+    if hp is None:
+        hp = _handler_profiles[name] = HandlerProfile()
+    hp.wall.observe(wall)
+    hp.db += prof["db"]
+    hp.api += prof["api"]
+    hp.cpu += prof["cpu"]
+    if SLOW_UPDATE_MS and wall * 1000 >= SLOW_UPDATE_MS:
+        hp.slow += 1
+        other = max(0.0, wall - prof["db"] - prof["api"] - prof["cpu"])
+        log.warning(
+            "slow update %s in %s: %.0f ms (db %.0f, api %.0f, cpu %.0f, other %.0f) kind=%s user=%s chat=%s",
+            getattr(update, "update_id", None), name, wall * 1000, prof["db"] * 1000, prof["api"] * 1000,
+            prof["cpu"] * 1000, other * 1000, _update_kind(update),
+            getattr(getattr(update, "effective_user", None), "id", None),
+            getattr(getattr(update, "effective_chat", None), "id", None),
+        )
+
+def _tracked(fn):
+    """نام هندلر را در contextvar می‌گذارد (نسبت‌دادن فراخوانی‌های API) و زمان DB/API/CPU آن را اندازه می‌گیرد."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(update, context):
+        token = _current_handler.set(name)
+        prof = {"db": 0.0, "api": 0.0, "cpu": 0.0}
+        prof_token = _update_profile.set(prof)
+        t0 = time.perf_counter()
+        try:
+            return await _CpuTimed(fn(update, context), prof)
+        finally:
+            _record_handler_profile(name, update, time.perf_counter() - t0, prof)
+            _update_profile.reset(prof_token)
+            _current_handler.reset(token)
+    return wrapper
+
+def handler_profile_text() -> str:
+    lines = ["⏱ هندلر — تعداد | p50/p99 | میانگین DB/API/CPU (ms) | کند"]
+    for name, hp in sorted(_handler_profiles.items(), key=lambda kv: -kv[1].wall.sum):
+        n = hp.wall.count or 1
+        lines.append(
+            f"{name} — {hp.wall.count} | {hp.wall.quantile(0.5) * 1000:.0f}/{hp.wall.quantile(0.99) * 1000:.0f}"
+            f" | {hp.db / n * 1000:.1f}/{hp.api / n * 1000:.1f}/{hp.cpu / n * 1000:.1f} | {hp.slow}"
+        )
+    return "\n".join(lines)
+
+async def run_profile(bot, chat_id: int, seconds: float):
+    """کل event loop را N ثانیه پروفایل می‌کند (yappi اگر نصب باشد، وگرنه cProfile) و خروجی pstats را می‌فرستد."""
+    global _profiling
+    if _profiling:
+        await bot.send_message(chat_id, "یک پروفایل در حال اجراست.")
+        return
+    _profiling = True
+    out = io.StringIO()
+    try:
+        if yappi is not None:
+            engine = "yappi"
+            yappi.set_clock_type("cpu")
+            yappi.clear_stats()
+            yappi.start()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                yappi.stop()
+            stats = pstats.Stats(yappi.convert2pstats(yappi.get_func_stats()), stream=out)
+            yappi.clear_stats()
+        else:
+            engine = "cProfile"
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+            stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats("cumulative").print_stats(80)
+        out.write("\n")
+        stats.sort_stats("tottime").print_stats(40)
+    finally:
+        _profiling = False
+    await bot.send_document(
+        chat_id,
+        document=out.getvalue().encode("utf-8"),
+        filename=f"profile-{engine}-{int(seconds)}s.txt",
+        caption=f"پروفایل {engine} به مدت {int(seconds)} ثانیه",
+    )
+
+def api_metrics_text() -> str:
+    lines = ["📡 متد — تعداد | p50/p99 (ms) | 429 | خطا"]
+    for method, m in sorted(_api_metrics.items(), key=lambda kv: -kv[1].latency.count):
+        errors = ", ".join(f"{k}:{v}" for k, v in sorted(m.errors.items(), key=lambda kv: -kv[1])) or "—"
+        lines.append(
+            f"{method} — {m.latency.count} | {m.latency.quantile(0.5) * 1000:.0f}/{m.latency.quantile(0.99) * 1000:.0f}"
+            f" | {m.retry_after} | {errors}"
+        )
+    by_handler: dict = {}
+    for (handler, _), n in _api_by_handler.items():
+        by_handler[handler] = by_handler.get(handler, 0) + n
+    if by_handler:
+        lines.append("")
+        lines.append("🧭 مصرف API به تفکیک هندلر:")
+        for handler, n in sorted(by_handler.items(), key=lambda kv: -kv[1])[:15]:
+            lines.append(f"{handler} — {n}")
+    if len(lines) == 1:
+        lines.append("هنوز فراخوانی‌ای ثبت نشده است.")
+    return "\n".join(lines)
+
+def _prom_label(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_histogram(out: list, name: str, labels: str, h: Histogram):
+    cumulative = 0
+    for bound, n in zip(h.buckets, h.counts):
+        cumulative += n
+        out.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    out.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+    out.append(f"{name}_sum{{{labels}}} {h.sum}")
+    out.append(f"{name}_count{{{labels}}} {h.count}")
+
+def prometheus_text() -> str:
+    out = [
+        "# TYPE najnaj_api_request_seconds histogram",
+    ]
+    for method, m in sorted(_api_metrics.items()):
+        _prom_histogram(out, "najnaj_api_request_seconds", f'method="{_prom_label(method)}"', m.latency)
+    out.append("# TYPE najnaj_api_errors_total counter")
+    for method, m in sorted(_api_metrics.items()):
+        for err, n in sorted(m.errors.items()):
+            out.append(f'najnaj_api_errors_total{{method="{_prom_label(method)}",error="{_prom_label(err)}"}} {n}')
+    out.append("# TYPE najnaj_api_calls_total counter")
+    for (handler, method), n in sorted(_api_by_handler.items()):
+        out.append(f'najnaj_api_calls_total{{handler="{_prom_label(handler)}",method="{_prom_label(method)}"}} {n}')
+    out.append("# TYPE najnaj_update_seconds histogram")
+    for kind, h in sorted(update_processor.latency.items()):
+        _prom_histogram(out, "najnaj_update_seconds", f'kind="{_prom_label(kind)}"', h)
+    out.append("# TYPE najnaj_db_hold_seconds histogram")
+    for site, m in sorted(_db_metrics.items()):
+        _prom_histogram(out, "najnaj_db_hold_seconds", f'site="{_prom_label(site)}"', m.hold)
+    out.append("# TYPE najnaj_db_wait_seconds histogram")
+    for site, m in sorted(_db_metrics.items()):
+        _prom_histogram(out, "najnaj_db_wait_seconds", f'site="{_prom_label(site)}"', m.wait)
+    out.append("# TYPE najnaj_handler_seconds histogram")
+    for name, hp in sorted(_handler_profiles.items()):
+        _prom_histogram(out, "najnaj_handler_seconds", f'handler="{_prom_label(name)}"', hp.wall)
+    out.append("# TYPE najnaj_handler_part_seconds_total counter")
+    for name, hp in sorted(_handler_profiles.items()):
+        for part in ("db", "api", "cpu"):
+            out.append(f'najnaj_handler_part_seconds_total{{handler="{_prom_label(name)}",part="{part}"}} {getattr(hp, part)}')
+    out.append("# TYPE najnaj_update_queue_size gauge")
+    out.append(f"najnaj_update_queue_size {app.update_queue.qsize() if app else 0}")
+    out.append("# TYPE najnaj_report_queue_size gauge")
+    out.append(f"najnaj_report_queue_size {report_queue_depth()}")
+    return "\n".join(out) + "\n"
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return web.Response(status=403)
+    return web.Response(text=prometheus_text(), content_type="text/plain", charset="utf-8")
+
+_metrics_runner: web.AppRunner | None = None
+
+async def start_metrics_server():
+    global _metrics_runner
+    webapp = web.Application()
+    webapp.router.add_get("/metrics", _metrics_handler)
+    _metrics_runner = web.AppRunner(webapp)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_LISTEN, METRICS_PORT).start()
+
+async def stop_metrics_server():
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+
+# ---------- وب‌هوک (aiohttp) ----------
+# فقط نوع‌هایی که هندلر دارند؛ chat_member و واکنش‌ها پیش‌فرض تلگرام نیستند و هر ورود/خروج یک آپدیت اضافه می‌شد.
+# صریح فرستاده می‌شود چون تلگرام مقدار قبلی allowed_updates را نگه می‌دارد.
+ALLOWED_UPDATES = [
+    Update.MESSAGE, Update.EDITED_MESSAGE, Update.CALLBACK_QUERY,
+    Update.INLINE_QUERY, Update.CHOSEN_INLINE_RESULT, Update.MY_CHAT_MEMBER,
+]
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")            # اگر تنظیم شود حالت وب‌هوک فعال است
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# بدون secret هر کسی می‌تواند آپدیت جعلی POST کند؛ اگر تنظیم نشده باشد برای هر اجرا یکی ساخته می‌شود
+# (با چند replica پشت یک آدرس، مقدار ثابت را در env بدهید تا setWebhook یکدیگر را باطل نکنند)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") or token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+BOT_API_BASE_URL = os.environ.get("BOT_API_BASE_URL", "")  # مثلاً http://127.0.0.1:8081/bot برای Bot API محلی/جعلی
+DROP_PENDING_UPDATES = os.environ.get("DROP_PENDING_UPDATES", "0") == "1"
+
+async def _webhook_handler(request: web.Request) -> web.Response:
+    if not hmac.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET
+    ):
+        return web.Response(status=403)
+    app_: Application = request.app["ptb"]
+    try:
+        update = Update.de_json(await request.json(), app_.bot)
+    except Exception:
+        update = None
+    if update is None:
+        return web.Response(status=400)
+    await app_.update_queue.put(update)
+    return web.Response()
+
+def build_web_app(app_: Application) -> web.Application:
+    webapp = web.Application()
+    webapp["ptb"] = app_
+    webapp.router.add_post(WEBHOOK_PATH, _webhook_handler)
+    if METRICS_TOKEN:
+        # شنوندهٔ وب‌هوک عمومی است؛ بدون توکن متریک‌ها فقط روی METRICS_LISTEN در دسترس‌اند
+        webapp.router.add_get("/metrics", _metrics_handler)
+    return webapp
+
+async def run_webhook(app_: Application):
+    await app_.initialize()
+    if app_.post_init:
+        await app_.post_init(app_)
+    await app_.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=DROP_PENDING_UPDATES,
+    )
+    await app_.start()
+    runner = web.AppRunner(build_web_app(app_))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if app_.running:
+            await app_.stop()
+        if app_.post_stop:
+            await app_.post_stop(app_)
+        await app_.shutdown()
+        if app_.post_shutdown:
+            await app_.post_shutdown(app_)
+
+# ---------- راه‌اندازی ----------
+def build_application() -> Application:
     global app
-    app = Application.builder().token(BOT_TOKEN).build()
+    builder = Application.builder().token(BOT_TOKEN)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL).base_file_url(BOT_API_BASE_URL.rstrip("/") + "/file/bot")
+    builder = builder.request(InstrumentedRequest(connection_pool_size=BOT_API_POOL_SIZE))
+    builder = builder.get_updates_request(InstrumentedRequest())
+    app = builder.concurrent_updates(update_processor).build()
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(on_checksub, pattern="^checksub$"))
@@ -1169,13 +3299,13 @@ def main():
     # راهنمای متنی در گروه
     app.add_handler(
         MessageHandler(
-            filters.ChatType.GROUPS & filters.TEXT & (~filters.COMMAND) & filters.Regex(r"^(?:راهنما|help|Help)$"),
+            filters.ChatType.GROUPS & HELP_FILTER,
             group_help
         )
     )
 
     # تریگرها در گروه
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.TEXT & (~filters.COMMAND), group_trigger))
+    app.add_handler(MessageHandler(filters.ChatType.GROUPS & TRIGGER_FILTER, group_trigger))
     app.add_handler(MessageHandler(filters.ChatType.GROUPS, any_group_message), group=2)
 
     # خصوصی
@@ -1187,7 +3317,7 @@ def main():
     app.add_handler(CallbackQueryHandler(on_inline_show, pattern=r"^iws:.+"))
 
     # نمایش نجوای ریپلای (id جدید و نسخه‌ی قدیمی)
-    app.add_handler(CallbackQueryHandler(on_show_by_id, pattern=r"^showid:\d+$"))
+    app.add_handler(CallbackQueryHandler(on_show_by_id, pattern=r"^showid:\d+(:\d{6})?$"))
     app.add_handler(CallbackQueryHandler(on_show_cb, pattern=r"^show:\-?\d+:\d+:\d+$"))
 
     # دکمهٔ بررسی عضویت در گروه
@@ -1196,7 +3326,22 @@ def main():
     # ظرفیت نصب و اخراج
     app.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
 
-    app.run_polling(drop_pending_updates=True)
+    # نسبت‌دادن فراخوانی‌های Bot API به هندلر جاری
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = _tracked(h.callback)
+
+    return app
+
+def main():
+    if not BOT_TOKEN or not DATABASE_URL or not ADMIN_ID:
+        raise SystemExit("BOT_TOKEN / DATABASE_URL / ADMIN_ID تنظیم نشده‌اند.")
+
+    app_ = build_application()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app_))
+    else:
+        app_.run_polling(drop_pending_updates=DROP_PENDING_UPDATES, allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
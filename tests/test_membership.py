@@ -0,0 +1,65 @@
+# tests/test_membership.py
+# -*- coding: utf-8 -*-
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+
+class FakeBot:
+    def __init__(self):
+        self.status = "member"
+        self.error = None
+        self.delay = 0.0
+        self.calls = 0
+
+    async def get_chat_member(self, chat, user_id):
+        self.calls += 1
+        status, error, delay = self.status, self.error, self.delay
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return SimpleNamespace(status=status)
+
+
+@pytest.fixture(autouse=True)
+def _clean_state():
+    main._member_cache._data.clear()
+    main._member_inflight.clear()
+    main._member_gen.clear()
+    yield
+
+
+def test_transient_errors_are_not_cached():
+    bot = FakeBot()
+    bot.error = RetryAfter(5)
+    ctx = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        assert await main.is_member_required_channel(ctx, 42) is False
+        assert 42 not in main._member_cache
+        bot.error = None
+        return await main.is_member_required_channel(ctx, 42)
+
+    assert asyncio.run(scenario()) is True
+    assert main._member_cache.get(42) is True
+
+
+def test_forced_recheck_is_not_overwritten_by_older_check():
+    bot = FakeBot()
+    ctx = SimpleNamespace(bot=bot)
+
+    async def scenario():
+        # بررسی قدیمی کند است و «عضو نیست» می‌بیند؛ «عضو شدم» بعداً شروع می‌شود ولی زودتر تمام می‌شود
+        bot.status, bot.delay = "left", 0.1
+        old = asyncio.ensure_future(main.is_member_required_channel(ctx, 7))
+        await asyncio.sleep(0.01)
+        bot.status, bot.delay = "member", 0.0
+        assert await main.is_member_required_channel(ctx, 7, force=True) is True
+        assert await old is False
+
+    asyncio.run(scenario())
+    assert main._member_cache.get(7) is True
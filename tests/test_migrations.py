@@ -0,0 +1,82 @@
+# tests/test_migrations.py
+# -*- coding: utf-8 -*-
+import asyncio
+
+import main
+
+
+class FakeTransaction:
+    def __init__(self, con):
+        self.con = con
+
+    async def __aenter__(self):
+        self.con.in_tx = True
+
+    async def __aexit__(self, *exc):
+        self.con.in_tx = False
+        return False
+
+
+class FakeConnection:
+    """فقط آن‌چه run_migrations لازم دارد؛ هر دستور با وضعیت تراکنش ثبت می‌شود."""
+
+    def __init__(self, version: int):
+        self.version = version
+        self.in_tx = False
+        self.log = []  # (sql, args, in_tx)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    async def execute(self, sql, *args):
+        self.log.append((sql, args, self.in_tx))
+
+    async def fetchval(self, sql, *args):
+        self.log.append((sql, args, self.in_tx))
+        if "FROM schema_version" in sql:
+            return self.version
+        return None  # pg_index: ایندکس نیمه‌کاره‌ای نیست
+
+    def recorded_versions(self):
+        return [args[0] for sql, args, _ in self.log if sql.startswith("INSERT INTO schema_version")]
+
+
+def test_versions_are_unique_and_increasing():
+    versions = [version for version, _, _ in main.MIGRATIONS]
+    assert versions[0] == 1
+    assert versions == list(range(1, len(versions) + 1))
+    assert all(name for _, name, _ in main.MIGRATIONS)
+
+
+def test_concurrent_steps_are_marked():
+    # CREATE INDEX CONCURRENTLY داخل تراکنش خطا می‌دهد، پس هر گامی که آن را اجرا کند باید علامت concurrent داشته باشد
+    for _, _, step in main.MIGRATIONS:
+        if isinstance(step, str):
+            assert "CONCURRENTLY" not in step.upper()
+            continue
+        con = FakeConnection(version=0)
+        asyncio.run(step(con))
+        if any("CONCURRENTLY" in sql for sql, _, _ in con.log):
+            assert getattr(step, "concurrent", False)
+
+
+def test_applies_only_missing_versions_in_order():
+    con = FakeConnection(version=3)
+    asyncio.run(main.run_migrations(con))
+    assert con.recorded_versions() == [v for v, _, _ in main.MIGRATIONS if v > 3]
+    assert con.log[0][0] == "SELECT pg_advisory_lock($1);"
+    assert con.log[-1][0] == "SELECT pg_advisory_unlock($1);"
+
+
+def test_concurrent_index_runs_outside_transaction():
+    con = FakeConnection(version=0)
+    asyncio.run(main.run_migrations(con))
+    created = [(sql, in_tx) for sql, _, in_tx in con.log if "CREATE INDEX CONCURRENTLY" in sql]
+    assert created and not any(in_tx for _, in_tx in created)
+    assert con.recorded_versions() == [v for v, _, _ in main.MIGRATIONS]
+
+
+def test_up_to_date_schema_runs_nothing():
+    con = FakeConnection(version=main.MIGRATIONS[-1][0])
+    asyncio.run(main.run_migrations(con))
+    assert con.recorded_versions() == []
@@ -0,0 +1,57 @@
+# tests/test_token_bucket.py
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import main
+
+
+def test_acquire_paces_to_rate():
+    async def scenario():
+        bucket = main.TokenBucket(50, 5)
+        t0 = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+        return time.monotonic() - t0
+
+    # توکن اول آماده است؛ پنج توکن بعدی با نرخ ۵۰ در ثانیه حدود ۰٫۱ ثانیه طول می‌کشند
+    elapsed = asyncio.run(scenario())
+    assert 0.08 <= elapsed < 0.3
+
+
+def test_penalize_halves_rate_down_to_min():
+    bucket = main.TokenBucket(40, 15)
+    bucket.penalize(0)
+    assert bucket.rate == 20
+    bucket.penalize(0)
+    assert bucket.rate == 15
+    bucket.penalize(0)
+    assert bucket.rate == 15
+
+
+def test_min_rate_never_exceeds_rate():
+    bucket = main.TokenBucket(5, 10)
+    assert bucket.min_rate == 5
+
+
+def test_penalize_blocks_acquire():
+    async def scenario():
+        bucket = main.TokenBucket(1000, 1)
+        await bucket.acquire()
+        bucket.penalize(0.1)
+        t0 = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - t0
+
+    assert asyncio.run(scenario()) >= 0.09
+
+
+def test_reward_recovers_up_to_max():
+    bucket = main.TokenBucket(10, 1)
+    bucket.penalize(0)
+    assert bucket.rate == 5
+    bucket.reward()
+    assert 5 < bucket.rate < 10
+    for _ in range(200):
+        bucket.reward()
+    assert bucket.rate == 10
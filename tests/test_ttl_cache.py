@@ -0,0 +1,52 @@
+# tests/test_ttl_cache.py
+# -*- coding: utf-8 -*-
+import pytest
+
+import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_expires_after_ttl(clock):
+    cache = main.TTLCache(10, 5)
+    cache.set("a", 1)
+    clock[0] += 4.9
+    assert cache.get("a") == 1
+    clock[0] += 0.2
+    assert cache.get("a") is None
+    assert "a" not in cache
+    assert len(cache) == 0
+
+
+def test_per_key_ttl(clock):
+    cache = main.TTLCache(10, 5)
+    cache.set("short", 1, ttl=1)
+    cache.set("long", 2)
+    clock[0] += 2
+    assert "short" not in cache
+    assert cache.get("long") == 2
+
+
+def test_evicts_least_recently_used(clock):
+    cache = main.TTLCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # a تازه شد؛ b قدیمی‌ترین است
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_falsy_values_and_pop(clock):
+    cache = main.TTLCache(10, 60)
+    cache.set("no", False)
+    assert "no" in cache
+    assert cache.get("no", "default") is False
+    assert cache.pop("no") is False
+    assert cache.pop("no", "gone") == "gone"
+    assert "no" not in cache
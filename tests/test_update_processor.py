@@ -0,0 +1,58 @@
+# tests/test_update_processor.py
+# -*- coding: utf-8 -*-
+import time
+import asyncio
+from datetime import datetime
+
+from telegram import Update, Message, Chat, User
+
+import main
+
+
+def _update(update_id: int, user_id: int) -> Update:
+    return Update(update_id, message=Message(
+        update_id, datetime.now(), Chat(user_id, "private"), from_user=User(user_id, "u", False), text="x"
+    ))
+
+
+async def _run(processor, jobs):
+    """jobs: [(update, مدت اجرا)] -> {update_id: زمان پایان نسبت به شروع}"""
+    start = time.perf_counter()
+    done = {}
+
+    async def work(update_id: int, seconds: float):
+        await asyncio.sleep(seconds)
+        done[update_id] = time.perf_counter() - start
+
+    await asyncio.gather(*(processor.process_update(u, work(u.update_id, sec)) for u, sec in jobs))
+    return done
+
+
+def test_same_user_updates_run_in_order():
+    processor = main.KeyedUpdateProcessor(4)
+    done = asyncio.run(_run(processor, [(_update(1, 7), 0.05), (_update(2, 7), 0.0), (_update(3, 7), 0.0)]))
+    assert sorted(done, key=done.get) == [1, 2, 3]
+    assert processor.queued == 0 and processor.active == 0 and not processor._locks
+
+
+def test_burst_from_one_user_does_not_starve_others():
+    # شش آپدیت کند از یک کاربر با ۴ ظرفیت نباید آپدیت فوری کاربر دیگر را پشت خود نگه دارند
+    processor = main.KeyedUpdateProcessor(4)
+    jobs = [(_update(i, 1), 0.2) for i in range(1, 7)] + [(_update(100, 2), 0.0)]
+    done = asyncio.run(_run(processor, jobs))
+    assert done[100] < 0.1
+    assert done[6] >= 1.2 - 0.05
+
+
+def test_concurrency_limit_applies_across_users():
+    processor = main.KeyedUpdateProcessor(2)
+    peak = [0]
+
+    async def scenario():
+        async def work():
+            peak[0] = max(peak[0], processor.active)
+            await asyncio.sleep(0.02)
+        await asyncio.gather(*(processor.process_update(_update(i, 1000 + i), work()) for i in range(6)))
+
+    asyncio.run(scenario())
+    assert peak[0] == 2
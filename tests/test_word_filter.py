@@ -0,0 +1,37 @@
+# tests/test_word_filter.py
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+
+from telegram import Chat, Message, Update, User
+
+import main
+
+
+def _message(text=None, **kw):
+    return Message(
+        message_id=1, date=datetime.now(timezone.utc), chat=Chat(-100, Chat.SUPERGROUP),
+        from_user=User(7, "u", False), text=text, **kw
+    )
+
+
+def test_matches_exact_word_after_strip():
+    assert main.TRIGGER_FILTER.filter(_message("نجوا"))
+    assert main.TRIGGER_FILTER.filter(_message("  سکرت\n"))
+    assert main.HELP_FILTER.filter(_message("help"))
+
+
+def test_rejects_other_text():
+    assert not main.TRIGGER_FILTER.filter(_message("نجوا کن"))
+    assert not main.TRIGGER_FILTER.filter(_message("سلام"))
+    assert not main.HELP_FILTER.filter(_message("HELP"))
+
+
+def test_rejects_messages_without_text():
+    assert not main.TRIGGER_FILTER.filter(_message(None))
+    assert not main.TRIGGER_FILTER.filter(_message(""))
+    assert not main.TRIGGER_FILTER.filter(_message(None, caption="نجوا"))
+
+
+def test_check_update_uses_message():
+    assert main.TRIGGER_FILTER.check_update(Update(1, message=_message("درگوشی")))
+    assert not main.TRIGGER_FILTER.check_update(Update(2, message=_message("درگوشی!")))